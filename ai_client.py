@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Google Antigravity AIOps Agent - AI Client Module
+genai.configure / GenerativeModel の生成を1か所にまとめ、プロセス内で使い回す。
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class AIModelManager:
+    """
+    (モデル名, generation_config) ごとに GenerativeModel を1つだけ作って共有する。
+    genai.configure はプロセス全体の設定なので、同時に有効な API キーは1つだけ（単一キー運用）。
+    キーが変わったら configure し直し、前のキーで作ったモデルは捨てる（古いキーのまま呼ばれないように）。
+    保持するモデルは最近使った max_models 個まで（温度などの組み合わせが増えても溜め込まない）。
+    """
+
+    def __init__(self, max_models: int = 16):
+        self._lock = threading.Lock()
+        self._models: "OrderedDict[Tuple[Hashable, ...], Any]" = OrderedDict()
+        self._max_models = max_models
+        self._configured_key: Optional[str] = None
+
+    def get_model(self, api_key: str, model_name: str, generation_config: Optional[Dict[str, Any]] = None):
+        key = (model_name, tuple(sorted((generation_config or {}).items())))
+        with self._lock:
+            import google.generativeai as genai  # 遅延 import（未使用時に SDK を読み込まない）
+            if self._configured_key != api_key:
+                genai.configure(api_key=api_key)
+                self._configured_key = api_key
+                self._models.clear()
+
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+
+            model = genai.GenerativeModel(model_name, generation_config=generation_config)
+            self._models[key] = model
+            if len(self._models) > self._max_models:
+                self._models.popitem(last=False)
+            return model
+
+    def cache_clear(self):
+        """保持しているモデルと設定済みキーを捨てる（キー差し替え時やテスト用）"""
+        with self._lock:
+            self._models.clear()
+            self._configured_key = None
+
+
+# 共有インスタンス
+ai_manager = AIModelManager()
+
+
+def parse_json_response(text: str) -> Dict[str, Any]:
+    """
+    モデル応答から JSON オブジェクトを取り出す。
+    JSON モードが使えないモデル（gemma 等）はコードブロックや前置きを付けることがあるので、
+    全体がそのまま読めなければ最初の "{" から最後の "}" までを読む。読めなければ ValueError。
+    """
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("No JSON object found in model response")
+    return json.loads(text[start:end + 1])
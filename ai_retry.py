@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Google Antigravity AIOps Agent - AI Retry Module
+AI 呼び出しの再試行（指数バックオフ + ジッター）とレート制限を1か所にまとめる。
+network_ops の生成系も app のレポート/チャットも、ai_call_retry と ai_rate_limiter を通して呼ぶ。
+"""
+
+import functools
+import os
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+
+def env_int(name: str, default: int, minimum: int = 0) -> int:
+    """環境変数を整数で読む（未設定・不正値は default、minimum 未満は minimum に切り上げ）"""
+    try:
+        return max(minimum, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+def backoff_delay(attempt: int, base: float = 0.25, cap: float = 4.0) -> float:
+    """attempt 回目（0 始まり）の失敗後に待つ秒数。ジッターで同時リトライの集中を避ける"""
+    return min(cap, base * 2 ** attempt) + random.uniform(0, base)
+
+
+def retry_with_backoff(
+    max_attempts: int = 3,
+    base: float = 0.25,
+    cap: float = 4.0,
+    retry_if: Optional[Callable[[BaseException], bool]] = None,
+    retry_after: Optional[Callable[[BaseException], Optional[float]]] = None,
+    max_retry_after: float = 10.0,
+):
+    """
+    例外時に指数バックオフで再試行するデコレーター。
+    retry_if を渡すと、それが True を返す例外だけ再試行する。最後の例外はそのまま送出。
+    retry_after を渡すと、サーバーが指定した待ち時間（Retry-After 等）を例外から取り出して優先する。
+    指定が max_retry_after 秒を超える場合は待たずにその例外を送出する（長いクォータ待ちで画面を止めない）。
+    """
+    def decorator(func):
+        def _delay(e, attempt):
+            """次の試行までの待ち秒数。再試行しないなら None"""
+            if attempt + 1 >= max_attempts or (retry_if is not None and not retry_if(e)):
+                return None
+            hinted = retry_after(e) if retry_after else None
+            if hinted is None:
+                return backoff_delay(attempt, base, cap)
+            return hinted if hinted <= max_retry_after else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    delay = _delay(e, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
+
+class RateLimiter:
+    """
+    トークンバケット方式のレート制限（max_rate 回 / time_period 秒）。スレッド間で同じバケットを共有する。
+    max_rate <= 0 なら制限しない。
+    """
+
+    def __init__(self, max_rate: float, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.rate = max_rate / time_period if max_rate > 0 else 0.0
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """トークンを1つ予約し、使えるようになるまでの待ち秒数を返す"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.max_rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+# =====================================================
+# Gemini API 向けの共通ポリシー
+# =====================================================
+
+def is_capacity_error(e: BaseException) -> bool:
+    """クォータ/容量系（429 / 503）のエラーか"""
+    from google.api_core import exceptions as google_exceptions  # 遅延 import
+    return isinstance(e, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+    ))
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """再試行で回復し得るエラー（容量系に加え、タイムアウト・接続断・サーバー内部エラー）"""
+    from google.api_core import exceptions as google_exceptions  # 遅延 import
+    return is_capacity_error(e) or isinstance(e, (
+        ConnectionError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+    ))
+
+
+def server_retry_after(e: BaseException) -> Optional[float]:
+    """エラーに含まれるサーバー指定の待ち時間（秒）。RetryInfo か Retry-After ヘッダーから読む。無ければ None"""
+    for detail in getattr(e, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers:
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+# 全 AI 呼び出しで共有するレート制限（AIOPS_AI_RPM 回/分、0 で無制限）
+ai_rate_limiter = RateLimiter(env_int("AIOPS_AI_RPM", 500), 60.0)
+
+# 一時的なエラーだけを再試行し、サーバーが待ち時間を指定していればそれに従い、
+# 無ければ 0.1 秒からのジッター付き指数バックオフで待つ
+ai_call_retry = retry_with_backoff(
+    max_attempts=3, base=0.1, cap=4.0,
+    retry_if=is_transient_error, retry_after=server_retry_after,
+)
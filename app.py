@@ -1,15 +1,18 @@
 import streamlit as st
-import graphviz
 import os
 import time
-import google.generativeai as genai
 import json
 import re
 import pandas as pd
-from google.api_core import exceptions as google_exceptions
+import numpy as np
+from bisect import bisect_left, bisect_right
+from copy import copy
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # モジュール群のインポート
 from logic import CausalInferenceEngine, Alarm, simulate_cascade_failure
+from data import build_children_index, build_redundancy_index
 
 # Multi-tenant registry
 from registry import (
@@ -18,14 +21,23 @@ from registry import (
     get_paths,
     load_topology,
     topology_mtime,
+    enumerate_scopes,
 )
-from network_ops import run_diagnostic_simulation, generate_remediation_commands, predict_initial_symptoms, generate_fake_log_by_ai
+from network_ops import run_diagnostic_simulation, generate_remediation_bundle, predict_initial_symptoms, generate_fake_log_by_ai, demo_pace
 from verifier import verify_log_content, format_verification_report
 from inference_engine import LogicalRCA
+from ai_client import ai_manager
+from ai_retry import ai_call_retry, ai_rate_limiter
 
 # --- ページ設定 ---
 st.set_page_config(page_title="AIOps Incident Cockpit", page_icon="⚡", layout="wide")
 
+# 全社一覧の集計を並列化するワーカー数（スコープ数が少なければそちらに合わせる）
+SCOPE_SUMMARY_WORKERS = 8
+# キャッシュの上限件数（mtime が変わるたびに古い世代が残るので件数で頭打ちにする）
+TOPOLOGY_CACHE_ENTRIES = 128  # トポロジー本体と索引・推論エンジン
+DERIVED_CACHE_ENTRIES = 256  # (トポロジー, シナリオ/アラーム等) ごとの派生結果
+
 # ==========================================
 # 関数定義
 # ==========================================
@@ -37,45 +49,87 @@ def display_company(tenant_id: str) -> str:
         return tenant_id
     return f"{tenant_id}社"
 
-def _node_type(node) -> str:
-    try:
-        return str(getattr(node, "type", "UNKNOWN"))
-    except Exception:
-        return "UNKNOWN"
-
-def _node_layer(node) -> int:
-    try:
-        return int(getattr(node, "layer", 999))
-    except Exception:
-        return 999
-
 def _find_target_node_id(topology: dict, node_type: str | None = None, layer: int | None = None, keyword: str | None = None) -> str | None:
     """トポロジから対象ノードIDを1つ選ぶ（最初の app.py の挙動に合わせた最小実装）"""
     for node_id, node in topology.items():
-        if node_type and _node_type(node) != node_type:
+        if node_type and node.type != node_type:
             continue
-        if layer is not None and _node_layer(node) != layer:
+        if layer is not None and node.layer != layer:
             continue
         if keyword and keyword not in str(node_id):
             continue
         return node_id
     return None
 
-def _make_alarms(topology: dict, selected_scenario: str):
-    """シナリオ文字列とトポロジ機器をマッチさせてアラームを生成（最初の app.py に準拠）"""
+def _build_type_index(topology: dict) -> dict:
+    """(type, layer) / (type, None) -> 最初に見つかったノードID の索引（トポロジを1回だけ走査）"""
+    index = {}
+    for node_id, node in topology.items():
+        index.setdefault((node.type, None), node_id)
+        index.setdefault((node.type, node.layer), node_id)
+    return index
+
+def _lookup_target_node_id(topology: dict, type_index: dict | None, node_type: str, layer: int | None = None) -> str | None:
+    """索引があれば O(1) で引き、無ければ従来どおり線形探索する"""
+    if type_index is None:
+        return _find_target_node_id(topology, node_type=node_type, layer=layer)
+    return type_index.get((node_type, layer))
+
+@st.cache_resource(show_spinner=False, max_entries=DERIVED_CACHE_ENTRIES)
+def _cascade_alarms(topology_path: str, mtime: float, root_cause_id: str, custom_message: str) -> list:
+    """simulate_cascade_failure の結果を (トポロジー, 起点, 障害文言) 単位で共有する。
+    戻り値は共有オブジェクトのため、呼び出し側で変更しないこと。
+    """
+    return simulate_cascade_failure(root_cause_id, _load_topology_cached(topology_path, mtime), custom_message)
+
+def _simulate_cascade(topology: dict, root_cause_id: str, custom_message: str = "Interface Down", topo_key: tuple | None = None) -> list:
+    """topo_key=(topology_path, mtime) が分かっていればキャッシュを使う。無ければその場で計算する"""
+    if topo_key is None:
+        return simulate_cascade_failure(root_cause_id, topology, custom_message)
+    return _cascade_alarms(*topo_key, root_cause_id, custom_message)
+
+# [WAN]/[FW]/[L2SW] シナリオ: 対象機器 (type, layer) と 障害 (メッセージ, 重大度) の静的テーブル
+DUAL_PSU_LOSS = "Power Supply: Dual Loss (Device Down)"
+_SCENARIO_DEVICES = (
+    ("[WAN]", ("ROUTER", None)),
+    ("[FW]", ("FIREWALL", None)),
+    ("[L2SW]", ("SWITCH", 4)),
+)
+_SCENARIO_FAULTS = (
+    ("電源障害：片系", ("Power Supply 1 Failed", "WARNING")),
+    ("電源障害：両系", (DUAL_PSU_LOSS, "CRITICAL")),
+    ("BGP", ("BGP Flapping", "WARNING")),
+    ("FAN", ("Fan Fail", "WARNING")),
+    ("メモリ", ("Memory High", "WARNING")),
+)
+
+def _device_fault_spec(selected_scenario: str):
+    """(node_type, layer, (message, severity) | None) を返す。対象機器が無いシナリオは None"""
+    for tag, (node_type, layer) in _SCENARIO_DEVICES:
+        if tag in selected_scenario:
+            break
+    else:
+        return None
+    fault = next((f for key, f in _SCENARIO_FAULTS if key in selected_scenario), None)
+    return node_type, layer, fault
+
+def _make_alarms(topology: dict, selected_scenario: str, type_index: dict | None = None, topo_key: tuple | None = None):
+    """シナリオ文字列とトポロジ機器をマッチさせてアラームを生成（最初の app.py に準拠）
+    topo_key=(topology_path, mtime) を渡すとカスケード計算をキャッシュから引く。
+    """
     alarms = []
     # Live はここでは生成しない
     if "Live" in selected_scenario:
         return alarms
 
     if "WAN全回線断" in selected_scenario:
-        rid = _find_target_node_id(topology, node_type="ROUTER")
+        rid = _lookup_target_node_id(topology, type_index, "ROUTER")
         if rid:
-            return simulate_cascade_failure(rid, topology)
+            return _simulate_cascade(topology, rid, topo_key=topo_key)
         return alarms
 
     if "FW片系障害" in selected_scenario:
-        fid = _find_target_node_id(topology, node_type="FIREWALL")
+        fid = _lookup_target_node_id(topology, type_index, "FIREWALL")
         if fid:
             return [Alarm(fid, "Heartbeat Loss", "WARNING")]
         return alarms
@@ -86,7 +140,7 @@ def _make_alarms(topology: dict, selected_scenario: str):
         if not target:
             target = _find_target_node_id(topology, keyword="L2_SW")
         if not target:
-            target = _find_target_node_id(topology, node_type="SWITCH")
+            target = _lookup_target_node_id(topology, type_index, "SWITCH")
 
         if target and target in topology:
             # 本来は「L2配下の端末(AP等)で症状が出る」想定。直下childが取れない場合もあるのでフォールバックします。
@@ -109,14 +163,14 @@ def _make_alarms(topology: dict, selected_scenario: str):
         return alarms
 
     if "複合障害" in selected_scenario:
-        rid = _find_target_node_id(topology, node_type="ROUTER")
+        rid = _lookup_target_node_id(topology, type_index, "ROUTER")
         if rid:
             return [Alarm(rid, "Power Supply 1 Failed", "CRITICAL"), Alarm(rid, "Fan Fail", "WARNING")]
         return alarms
 
     if "同時多発" in selected_scenario:
-        fw = _find_target_node_id(topology, node_type="FIREWALL")
-        ap = _find_target_node_id(topology, node_type="ACCESS_POINT")
+        fw = _lookup_target_node_id(topology, type_index, "FIREWALL")
+        ap = _lookup_target_node_id(topology, type_index, "ACCESS_POINT")
         if fw:
             alarms.append(Alarm(fw, "Heartbeat Loss", "WARNING"))
         if ap:
@@ -124,36 +178,26 @@ def _make_alarms(topology: dict, selected_scenario: str):
         return alarms
 
     # それ以外：[WAN]/[FW]/[L2SW] を type にマップ
-    target_device_id = None
-    if "[WAN]" in selected_scenario:
-        target_device_id = _find_target_node_id(topology, node_type="ROUTER")
-    elif "[FW]" in selected_scenario:
-        target_device_id = _find_target_node_id(topology, node_type="FIREWALL")
-    elif "[L2SW]" in selected_scenario:
-        target_device_id = _find_target_node_id(topology, node_type="SWITCH", layer=4)
-
-    if not target_device_id:
+    spec = _device_fault_spec(selected_scenario)
+    if spec is None:
         return alarms
+    node_type, layer, fault = spec
 
-    if "電源障害：片系" in selected_scenario:
-        return [Alarm(target_device_id, "Power Supply 1 Failed", "WARNING")]
+    target_device_id = _lookup_target_node_id(topology, type_index, node_type, layer)
+    if not target_device_id or fault is None:
+        return alarms
 
-    if "電源障害：両系" in selected_scenario:
+    message, severity = fault
+    if message == DUAL_PSU_LOSS:
         # ルータ等はカスケード、FWは単体down
         if "FW" in str(target_device_id):
-            return [Alarm(target_device_id, "Power Supply: Dual Loss (Device Down)", "CRITICAL")]
-        return simulate_cascade_failure(target_device_id, topology, "Power Supply: Dual Loss (Device Down)")
+            return [Alarm(target_device_id, DUAL_PSU_LOSS, "CRITICAL")]
+        return _simulate_cascade(topology, target_device_id, DUAL_PSU_LOSS, topo_key)
+    return [Alarm(target_device_id, message, severity)]
 
-    if "BGP" in selected_scenario:
-        return [Alarm(target_device_id, "BGP Flapping", "WARNING")]
-
-    if "FAN" in selected_scenario:
-        return [Alarm(target_device_id, "Fan Fail", "WARNING")]
-
-    if "メモリ" in selected_scenario:
-        return [Alarm(target_device_id, "Memory High", "WARNING")]
-
-    return alarms
+# 件数 -> 状態 の段（しきい値, 状態）。bisect で分岐なしに引く
+_WARN_COUNT_LADDER = ((3, 10), ("注意", "要対応", "停止"))
+_ALARM_COUNT_LADDER = ((1, 3, 20), ("正常", "注意", "要対応", "停止"))
 
 def _status_from_alarms(selected_scenario: str, alarms) -> str:
     """全社一覧の状態（停止/要対応/注意/正常）を判定する。
@@ -176,21 +220,10 @@ def _status_from_alarms(selected_scenario: str, alarms) -> str:
         return "要対応"
 
     # WARNING/INFO のみ：件数で注意/要対応を分ける（将来はSLOやImpactで置換）
-    n = len(alarms)
-    if n < 3:
-        return "注意"
-    if n < 10:
-        return "要対応"
-    return "停止"
+    return _WARN_COUNT_LADDER[1][bisect_right(_WARN_COUNT_LADDER[0], len(alarms))]
 def _status_from_alarm_count(n: int) -> str:
     # 互換用（旧ロジック）。全社一覧では _status_from_alarms を使用。
-    if n >= 20:
-        return "停止"
-    if n >= 3:
-        return "要対応"
-    if n >= 1:
-        return "注意"
-    return "正常"
+    return _ALARM_COUNT_LADDER[1][bisect_right(_ALARM_COUNT_LADDER[0], n)]
 def _status_sort_key(status: str) -> int:
     # 左ほど優先度が高い（停止 → 要対応 → 注意 → 正常）
     order = {"停止": 0, "要対応": 1, "注意": 2, "正常": 3}
@@ -221,37 +254,130 @@ def _safe_dataframe_select(view_df, key: str, height: int):
         st.dataframe(view_df, use_container_width=True, hide_index=True, height=height)
         return None
 
-def _collect_all_scopes():
-    scopes = []
-    for t in list_tenants():
-        for n in list_networks(t):
-            scopes.append((t, n))
-    return scopes
+@st.cache_resource(show_spinner=False, max_entries=TOPOLOGY_CACHE_ENTRIES)
+def _load_topology_cached(topology_path: str, mtime: float) -> dict:
+    """トポロジーをプロセス内で共有（mtime をキーに含めて変更時のみ再読込。cache_resource なので dict のハッシュ/コピーは発生しない）"""
+    return load_topology(Path(topology_path))
+
+@st.cache_resource(show_spinner=False, max_entries=TOPOLOGY_CACHE_ENTRIES)
+def _load_type_index(topology_path: str, mtime: float) -> dict:
+    """トポロジーごとの (type, layer) 索引（トポロジー本体と同じキーで共有）"""
+    return _build_type_index(_load_topology_cached(topology_path, mtime))
+
+@st.cache_resource(show_spinner=False, max_entries=TOPOLOGY_CACHE_ENTRIES)
+def _load_topology_indexes(topology_path: str, mtime: float) -> tuple:
+    """(parent -> 子ID一覧, redundancy_group -> メンバーID一覧)（トポロジー本体と同じキーで共有）"""
+    topo = _load_topology_cached(topology_path, mtime)
+    return build_children_index(topo), build_redundancy_index(topo)
+
+@st.cache_resource(show_spinner=False, max_entries=TOPOLOGY_CACHE_ENTRIES)
+def _load_node_search_index(topology_path: str, mtime: float) -> dict:
+    return _build_node_search_index(_load_topology_cached(topology_path, mtime))
+
+@st.cache_resource(show_spinner=False, max_entries=TOPOLOGY_CACHE_ENTRIES)
+def _logic_engine(topology_path: str, mtime: float, config_dir: str = "./configs", silent_ratio: float = 0.5) -> LogicalRCA:
+    """LogicalRCA をトポロジー（+ サイレント判定閾値）ごとに1つだけ生成して全セッションで共有する。
+    共有インスタンスなので、閾値はキャッシュキーに含めて生成後は書き換えない。
+    """
+    engine = LogicalRCA(_load_topology_cached(topology_path, mtime), config_dir=config_dir)
+    engine.SILENT_RATIO = silent_ratio
+    return engine
+
+class _UncachedAnalysis(Exception):
+    """AI 分析が失敗した結果を、キャッシュさせずに呼び出し元へ運ぶ（st.cache_data は例外を記録しない）"""
+    def __init__(self, results: list):
+        super().__init__("AI analysis failed; result not cached")
+        self.results = results
+
+@st.cache_data(show_spinner=False, max_entries=DERIVED_CACHE_ENTRIES)
+def _analyze_cached(topology_path: str, mtime: float, silent_ratio: float, api_configured: bool, alarm_key: tuple, _alarms: list) -> list:
+    """LogicalRCA.analyze の結果を (トポロジー, 閾値, API有無, アラーム列) ごとにメモ化する。
+    alarm_key は (device_id, message, severity) の並び（順序は結果の同率順に影響するので保持）。
+    _alarms は同じ内容の Alarm 列でハッシュ対象外。
+    AI 呼び出しが一時的に失敗した候補（AI_ERROR）を含む結果は覚えず、次回は分析し直す。
+    """
+    results = _logic_engine(topology_path, mtime, silent_ratio=silent_ratio).analyze(_alarms)
+    if any(c.type == "AI_ERROR" for c in results):
+        raise _UncachedAnalysis(results)
+    return results
 
-def _build_company_rows(selected_scenario: str):
+def _analyze(topology_path: str, mtime: float, silent_ratio: float, api_configured: bool, alarm_key: tuple, alarms: list) -> list:
+    try:
+        return _analyze_cached(topology_path, mtime, silent_ratio, api_configured, alarm_key, alarms)
+    except _UncachedAnalysis as e:
+        return e.results
+
+@st.cache_resource(show_spinner=False, max_entries=DERIVED_CACHE_ENTRIES)
+def _summarize_topology(selected_scenario: str, topology_path: str, mtime: float) -> tuple:
+    """1トポロジー分の状態 (status, alarm_count)（2段目のキャッシュ: mtime が変わったトポロジーだけ再計算）
+    tenant/network には依存しないので、同じトポロジーを共有するスコープは同じエントリを使う。
+    戻り値は不変の小さな tuple なので、ヒット時の pickle/コピーを省ける cache_resource にする。
     """
-    全社の状態を作る（現状は: アラーム件数ベース + Maintenanceフラグ + デルタ）
+    topo = _load_topology_cached(topology_path, mtime)
+    type_index = _load_type_index(topology_path, mtime)
+
+    alarms = _make_alarms(topo, selected_scenario, type_index, (topology_path, mtime))
+    return (_status_from_alarms(selected_scenario, alarms), len(alarms))
+
+@st.cache_data(show_spinner=False, max_entries=DERIVED_CACHE_ENTRIES)
+def _summarize_all_scopes(selected_scenario: str, topo_keys: tuple) -> list:
+    """全スコープの状態（1段目のキャッシュ）
+    キーは (scenario, スコープ順の (topology_path, mtime) 列)。どのトポロジーが差し替わっても
+    （mtime が古い方へ戻った場合も）キーが変わる。
+    ミス時は (topology_path, mtime) ごとに1回だけ集計し、スコープへ配り直す（順序は scopes のまま）。
+    集計は互いに独立なのでスレッドプールで並列に埋める。
     """
-    maint_flags = st.session_state.get("maint_flags", {}) or {}
+    unique_keys = list(dict.fromkeys(topo_keys))
 
-    # 前回状態（デルタ計算用）
-    prev = st.session_state.get("prev_company_snapshot", {}) or {}
+    def _one(key):
+        topology_path, mtime = key
+        return _summarize_topology(selected_scenario, topology_path, mtime)
 
-    rows = []
-    for tenant_id, network_id in _collect_all_scopes():
-        paths = get_paths(tenant_id, network_id)
-        topo = load_topology(paths.topology_path)
+    if len(unique_keys) <= 1:
+        results = [_one(key) for key in unique_keys]
+    else:
+        with ThreadPoolExecutor(max_workers=min(SCOPE_SUMMARY_WORKERS, len(unique_keys))) as ex:
+            results = list(ex.map(_one, unique_keys))
+    by_key = dict(zip(unique_keys, results))
+    return [by_key[k] for k in topo_keys]
 
-        alarms = _make_alarms(topo, selected_scenario)
-        alarm_count = len(alarms)
+NORMAL_SCENARIO = "正常稼働"
+_NORMAL_SUMMARY = ("正常", 0)
 
-        status = _status_from_alarms(selected_scenario, alarms)
-        is_maint = bool(maint_flags.get(tenant_id, False))
+def _build_company_rows(selected_scenario: str):
+    """
+    全社の状態を作る（現状は: アラーム件数ベース + Maintenanceフラグ + デルタ）
+    """
+    maint_flags = st.session_state.get("maint_flags", {}) or {}
 
-        key = f"{tenant_id}/{network_id}"
-        prev_count = prev.get(key, {}).get("alarm_count")
-        delta = None if prev_count is None else (alarm_count - prev_count)
+    entries = enumerate_scopes()
+    scopes = tuple((e[0], e[1]) for e in entries)
+    if selected_scenario == NORMAL_SCENARIO:
+        # 正常稼働はアラームが出ないので集計・キャッシュ参照を丸ごと省く
+        summaries = [_NORMAL_SUMMARY] * len(scopes)
+    else:
+        topo_keys = tuple((e[2], e[3]) for e in entries)
+        summaries = _summarize_all_scopes(selected_scenario, topo_keys)
+
+    # デルタ: 前回状態は SoA（スコープ並び tuple + 件数 int32 配列）で持ち、並びが同じならベクトル減算
+    counts = np.fromiter((c for _, c in summaries), dtype=np.int32, count=len(summaries))
+    prev_scopes = st.session_state.get("prev_company_scopes")
+    prev_counts = st.session_state.get("prev_company_counts")
+    if prev_scopes is None or prev_counts is None:
+        deltas = [None] * len(scopes)
+    elif prev_scopes == scopes:
+        deltas = (counts - prev_counts).tolist()
+    else:
+        prev_index = {k: i for i, k in enumerate(prev_scopes)}
+        deltas = [
+            None if (i := prev_index.get(k)) is None else int(c) - int(prev_counts[i])
+            for k, c in zip(scopes, counts)
+        ]
+    st.session_state.prev_company_scopes = scopes
+    st.session_state.prev_company_counts = counts
 
+    rows = []
+    for (tenant_id, network_id), (status, alarm_count), delta in zip(scopes, summaries, deltas):
         rows.append({
             "tenant": tenant_id,
             "network": network_id,
@@ -259,16 +385,24 @@ def _build_company_rows(selected_scenario: str):
             "status": status,
             "alarm_count": alarm_count,
             "delta": delta,
-            "maintenance": is_maint,
+            "maintenance": bool(maint_flags.get(tenant_id, False)),
         })
 
-    # snapshot更新
-    st.session_state.prev_company_snapshot = {
-        f'{r["tenant"]}/{r["network"]}': {"alarm_count": r["alarm_count"]} for r in rows
-    }
-
     return rows
 
+BOARD_BUCKETS = ("停止", "要対応", "注意", "正常")
+
+@st.cache_data(show_spinner=False)
+def _bucketize(digest: tuple) -> dict:
+    """digest=((status, alarm_count, company_network), ...) をバケットごとのソート済み行インデックスにする"""
+    out = {b: [] for b in BOARD_BUCKETS}
+    for i, (status, _, _) in enumerate(digest):
+        if status in out:
+            out[status].append(i)
+    for idxs in out.values():
+        idxs.sort(key=lambda i: (-digest[i][1], digest[i][2]))
+    return out
+
 def _render_all_companies_board(selected_scenario: str, df_height: int = 220):
     """
     上段: 全社状態ボード（停止/要対応/注意/正常）
@@ -279,12 +413,13 @@ def _render_all_companies_board(selected_scenario: str, df_height: int = 220):
 
     rows = _build_company_rows(selected_scenario)
 
-    # Bucketごとに並べる
-    buckets = ["停止", "要対応", "注意", "正常"]
+    # Bucketごとに並べる（rows が同じなら振り分け/ソート結果をキャッシュから再利用）
+    buckets = list(BOARD_BUCKETS)
     cols = st.columns(4, gap="large")
+    bucket_rows = _bucketize(tuple((r["status"], r["alarm_count"], r["company_network"]) for r in rows))
 
     # サマリ（上の小カード）
-    counts = {b: sum(1 for r in rows if r["status"] == b) for b in buckets}
+    counts = {b: len(bucket_rows[b]) for b in buckets}
     for c, b in zip(cols, buckets):
         with c:
             st.markdown(f"### {_make_status_badge(b)}  **{counts[b]}**")
@@ -294,8 +429,7 @@ def _render_all_companies_board(selected_scenario: str, df_height: int = 220):
     # 各列の中身（スクロール可能な表）
     for c, b in zip(cols, buckets):
         with c:
-            items = [r for r in rows if r["status"] == b]
-            items.sort(key=lambda r: (-r["alarm_count"], r["company_network"]))
+            items = [rows[i] for i in bucket_rows[b]]
 
             if not items:
                 st.caption("（該当なし）")
@@ -321,23 +455,53 @@ def _render_all_companies_board(selected_scenario: str, df_height: int = 220):
                 sel = items[selected_idx]
                 st.session_state.selected_scope = {"tenant": sel["tenant"], "network": sel["network"]}
 
+def _fragment(run_every=None):
+    """st.fragment（旧版は experimental_fragment）で部分再実行する。どちらも無ければ通常関数のまま"""
+    frag = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    if frag is None:
+        return lambda fn: fn
+    return frag(run_every=run_every)
+
+@_fragment(run_every=10)
+def _all_companies_board_fragment(selected_scenario: str, df_height: int = 220):
+    """全社状態ボードを fragment として描画（チャット入力等の無関係な rerun では再実行しない）
+    行クリックで選択スコープが変わったときだけ、下段コックピットへ反映するため全体を rerun する。
+    """
+    before = st.session_state.get("selected_scope")
+    _render_all_companies_board(selected_scenario, df_height=df_height)
+    if st.session_state.get("selected_scope") != before:
+        st.rerun()
+
 # ==========================================
-def find_target_node_id(topology, node_type=None, layer=None, keyword=None):
-    """トポロジーから条件に合うノードIDを検索"""
+def _build_node_search_index(topology) -> dict:
+    """find_target_node_id 用の索引: type / layer -> ノードID一覧、ノードID -> キーワード検索用文字列"""
+    by_type, by_layer, haystack = {}, {}, {}
     for node_id, node in topology.items():
-        if node_type and node.type != node_type: continue
-        if layer and node.layer != layer: continue
-        if keyword:
-            hit = False
-            if keyword in node_id: hit = True
-            for v in node.metadata.values():
-                if isinstance(v, str) and keyword in v: hit = True
-            if not hit: continue
+        by_type.setdefault(node.type, []).append(node_id)
+        by_layer.setdefault(node.layer, []).append(node_id)
+        # ID とメタデータの文字列値を区切り文字付きで連結（境界をまたいだ誤ヒットを防ぐ）
+        haystack[node_id] = "\x00".join([node_id, *(v for v in node.metadata.values() if isinstance(v, str))])
+    return {"by_type": by_type, "by_layer": by_layer, "haystack": haystack}
+
+def find_target_node_id(topology, node_type=None, layer=None, keyword=None, index=None):
+    """トポロジーから条件に合うノードIDを検索（index があれば type/layer で候補を絞る）"""
+    if index is None:
+        index = _build_node_search_index(topology)
+    if node_type:
+        candidates = index["by_type"].get(node_type, ())
+    elif layer:
+        candidates = index["by_layer"].get(layer, ())
+    else:
+        candidates = topology.keys()
+    for node_id in candidates:
+        if layer and topology[node_id].layer != layer: continue
+        if keyword and keyword not in index["haystack"][node_id]: continue
         return node_id
     return None
 
-def load_config_by_id(device_id):
-    """configsフォルダから設定ファイルを読み込む"""
+@st.cache_data(show_spinner=False)
+def load_config_by_id(device_id: str) -> str:
+    """configsフォルダから設定ファイルを読み込む（プロセス内で不変とみなしてキャッシュ）"""
     possible_paths = [f"configs/{device_id}.txt", f"{device_id}.txt"]
     for path in possible_paths:
         if os.path.exists(path):
@@ -424,31 +588,36 @@ def load_config_sanitized(device_id: str) -> dict:
     }
 
 
-def generate_content_with_retry(model, prompt, stream=True, retries=3):
-    """503エラー対策のリトライ付き生成関数"""
-    for i in range(retries):
-        try:
-            return model.generate_content(prompt, stream=stream)
-        except google_exceptions.ServiceUnavailable:
-            if i == retries - 1: raise
-            time.sleep(2 * (i + 1))
-    return None
-
-def render_topology(alarms, root_cause_candidates):
-    """トポロジー図の描画 (AI判定結果を反映)"""
-    graph = graphviz.Digraph()
-    graph.attr(rankdir='TB')
-    graph.attr('node', shape='box', style='rounded,filled', fontname='Helvetica')
-    
-    alarm_map = {a.device_id: a for a in alarms}
-    alarmed_ids = set(alarm_map.keys())
+@ai_call_retry
+def generate_content_with_retry(model, prompt, stream=True):
+    """レポート/チャット用の生成。再試行とレート制限は network_ops の生成系と共通（ai_retry）"""
+    ai_rate_limiter.acquire()
+    return model.generate_content(prompt, stream=stream)
+
+def _dot_quote(text: str) -> str:
+    """DOT の二重引用符文字列にする（\\ と " をエスケープし、改行は DOT の \\n に）"""
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+@st.cache_data(show_spinner=False, max_entries=DERIVED_CACHE_ENTRIES)
+def _topology_dot(topology_path: str, mtime: float, alarmed_ids: tuple, node_status_items: tuple) -> str:
+    """トポロジー図の DOT ソース（トポロジー/アラーム/AI判定が同じ rerun では組み立てを省く）"""
+    topology = _load_topology_cached(topology_path, mtime)
+    _, redundancy_index = _load_topology_indexes(topology_path, mtime)
+
+    lines = [
+        "digraph {",
+        "\trankdir=TB",
+        '\tnode [fontname=Helvetica shape=box style="rounded,filled"]',
+    ]
+    # ノードと辺を1回の走査で作る（出力順は従来どおり: 全ノード → 全辺）
+    edge_lines = []
     
-    root_cause_ids = {c['id'] for c in root_cause_candidates if c['prob'] > 0.6}
+    alarmed_ids = set(alarmed_ids)
     
     # AI判定結果のマッピング
-    node_status_map = {c['id']: c['type'] for c in root_cause_candidates}
+    node_status_map = dict(node_status_items)
     
-    for node_id, node in TOPOLOGY.items():
+    for node_id, node in topology.items():
         color = "#e8f5e9"
         penwidth = "1"
         fontcolor = "black"
@@ -476,18 +645,81 @@ def render_topology(alarms, root_cause_candidates):
         elif node_id in alarmed_ids:
             color = "#fff9c4" 
         
-        graph.node(node_id, label=label, fillcolor=color, color='black', penwidth=penwidth, fontcolor=fontcolor)
-    
-    for node_id, node in TOPOLOGY.items():
+        lines.append(
+            f'\t{_dot_quote(node_id)} [label={_dot_quote(label)} color=black '
+            f'fillcolor="{color}" fontcolor="{fontcolor}" penwidth={penwidth}]'
+        )
+
         if node.parent_id:
-            graph.edge(node.parent_id, node_id)
-            parent_node = TOPOLOGY.get(node.parent_id)
+            quoted_id = _dot_quote(node_id)
+            edge_lines.append(f"\t{_dot_quote(node.parent_id)} -> {quoted_id}")
+            parent_node = topology.get(node.parent_id)
             if parent_node and parent_node.redundancy_group:
-                partners = [n.id for n in TOPOLOGY.values() 
-                           if n.redundancy_group == parent_node.redundancy_group and n.id != parent_node.id]
-                for partner_id in partners:
-                    graph.edge(partner_id, node_id)
-    return graph
+                for partner_id in redundancy_index.get(parent_node.redundancy_group, ()):
+                    if partner_id != parent_node.id:
+                        edge_lines.append(f"\t{_dot_quote(partner_id)} -> {quoted_id}")
+
+    lines.extend(edge_lines)
+    lines.append("}")
+    return "\n".join(lines)
+
+def render_topology(alarms, root_cause_candidates, topology_path: str, mtime: float) -> str:
+    """トポロジー図の描画 (AI判定結果を反映)。キャッシュキー用にアラーム/判定結果を tuple 化して渡す"""
+    alarmed_ids = tuple(sorted({a.device_id for a in alarms}))
+    node_status_items = tuple(sorted({c.id: c.type for c in root_cause_candidates}.items()))
+    return _topology_dot(topology_path, mtime, alarmed_ids, node_status_items)
+
+# コックピット表の確信度 -> (ステータス, 推奨アクション)。prob > 0.6 / > 0.8 で段が上がる（bisect_left で境界値は下の段）
+_COCKPIT_PROB_LADDER = (
+    (0.6, 0.8),
+    (("⚪ 監視中", "👁️ 静観"), ("🟡 警告 (被疑箇所)", "🔍 詳細調査を推奨"), ("🔴 危険 (根本原因)", "🚀 自動修復が可能")),
+)
+
+@st.cache_data(show_spinner=False)
+def _build_cockpit_df(cand_key: tuple, stopped: bool) -> pd.DataFrame:
+    """コックピット表（cand_key = ((id, label, prob, type, has_verification_log), ...)。同じ候補列なら再構築しない）"""
+    df_data = []
+    # ★修正: スライス制限を撤廃 (全件表示)
+    # 階層ロジックにより、重要なもの(Tier高)が先頭に来るため、大量にあっても問題ない
+    for rank, (cand_id, label, prob, cand_type, has_verification_log) in enumerate(cand_key, 1):
+        # サイレント障害の表現強化: 症状(端末)ではなく「上位設備の疑い」として強調
+        type_str = str(cand_type or "")
+        if "Silent" in type_str or "サイレント" in type_str:
+            status, action = "🟣 サイレント疑い (上位設備)", "🔍 上位SW/配下影響を確認"
+        else:
+            status, action = _COCKPIT_PROB_LADDER[1][bisect_left(_COCKPIT_PROB_LADDER[0], prob)]
+
+        if "Network/Unreachable" in cand_type or "Network/Secondary" in cand_type:
+            status = "⚫ 応答なし (上位障害)"
+            action = "⛔ 対応不要 (上位復旧待ち)"
+
+        candidate_text = f"デバイス: {cand_id} / 原因: {label}"
+        if has_verification_log:
+            candidate_text += " [🔍 Active Probe: 応答なし]"
+
+        df_data.append({
+            "順位": rank,
+            "ステータス": status,
+            "根本原因候補": candidate_text,
+            "リスクスコア": (None if stopped else prob),
+            "推奨アクション": action,
+            "ID": cand_id,
+            "Type": cand_type
+        })
+    return pd.DataFrame(df_data)
+
+# シナリオ単位のセッション状態と既定値（シナリオ切り替え時もこの値に戻す）
+_SESSION_DEFAULTS = {
+    "live_result": None,
+    "messages": [],
+    "chat_session": None,
+    "trigger_analysis": False,
+    "verification_result": None,
+    "generated_report": None,
+    "verification_log": None,
+    "last_report_cand_id": None,
+    "remediation_verification": None,
+}
 
 # --- UI構築 ---
 
@@ -544,7 +776,7 @@ if "selected_scope" not in st.session_state:
     st.session_state.selected_scope = None
 
 # 上段の全社状態ボード（クリックで下段切替）
-_render_all_companies_board(selected_scenario, df_height=DF_HEIGHT_5ROWS)
+_all_companies_board_fragment(selected_scenario, df_height=DF_HEIGHT_5ROWS)
 st.markdown("---")
 
 # 選択スコープ（状態ボードの行クリックで切替）
@@ -566,38 +798,24 @@ else:
 
 # テナントごとのトポロジー読み込み
 _paths = get_paths(ACTIVE_TENANT, ACTIVE_NETWORK)
-TOPOLOGY = load_topology(_paths.topology_path)
-
-# 変数初期化
-for key in ["live_result", "messages", "chat_session", "trigger_analysis", "verification_result", "generated_report", "verification_log", "last_report_cand_id", "logic_engine"]:
-    if key not in st.session_state:
-        st.session_state[key] = None if key != "messages" and key != "trigger_analysis" else ([] if key == "messages" else False)
-
-# エンジン初期化（スコープ変更に追随）
-# マルチテナントでは tenant/network 切替でトポロジーが変わるため、
-# LogicalRCA は毎回「現在スコープの TOPOLOGY」で初期化する必要があります。
-try:
-    topo_mtime = os.path.getmtime(_paths.topology_path)
-except Exception:
-    topo_mtime = 0.0
-engine_sig = f"{ACTIVE_TENANT}/{ACTIVE_NETWORK}:{topo_mtime}"
-
-if st.session_state.get("logic_engine_sig") != engine_sig:
-    st.session_state.logic_engine = LogicalRCA(TOPOLOGY)
-    st.session_state.logic_engine_sig = engine_sig
+topo_mtime = topology_mtime(_paths.topology_path)
+TOPOLOGY = _load_topology_cached(str(_paths.topology_path), topo_mtime)
+TOPO_KEY = (str(_paths.topology_path), topo_mtime)
+TOPO_CHILDREN, _ = _load_topology_indexes(str(_paths.topology_path), topo_mtime)
+NODE_INDEX = _load_node_search_index(str(_paths.topology_path), topo_mtime)
+
+# 変数初期化（既定値は _SESSION_DEFAULTS。可変値はセッション間で共有しないようコピーして入れる）
+for key, value in _SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, copy(value))
+
+# エンジンはスコープ（トポロジー）ごとに _logic_engine で共有し、分析結果は _analyze_cached でメモ化（AI 失敗時は除く）
 # シナリオ切り替え時のリセット
+# （メインパネル描画より前にリセットするので、同じ実行のまま続行できる。st.rerun() で全体を再実行しない）
 if st.session_state.current_scenario != selected_scenario:
     st.session_state.current_scenario = selected_scenario
-    st.session_state.messages = []      
-    st.session_state.chat_session = None 
-    st.session_state.live_result = None 
-    st.session_state.trigger_analysis = False
-    st.session_state.verification_result = None
-    st.session_state.generated_report = None
-    st.session_state.verification_log = None 
-    st.session_state.last_report_cand_id = None
+    for key, value in _SESSION_DEFAULTS.items():
+        st.session_state[key] = copy(value)
     if "remediation_plan" in st.session_state: del st.session_state.remediation_plan
-    st.rerun()
 
 # ==========================================
 # メインロジック
@@ -610,10 +828,10 @@ is_live_mode = False
 # 1. アラーム生成ロジック
 if "Live" in selected_scenario: is_live_mode = True
 elif "WAN全回線断" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    if target_device_id: alarms = simulate_cascade_failure(target_device_id, TOPOLOGY)
+    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER", index=NODE_INDEX)
+    if target_device_id: alarms = _simulate_cascade(TOPOLOGY, target_device_id, topo_key=TOPO_KEY)
 elif "FW片系障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
+    target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL", index=NODE_INDEX)
     if target_device_id:
         alarms = [Alarm(target_device_id, "Heartbeat Loss", "WARNING")]
         root_severity = "WARNING"
@@ -621,61 +839,54 @@ elif "FW片系障害" in selected_scenario:
 elif "L2SWサイレント障害" in selected_scenario:
     target_device_id = "L2_SW_01"
     if target_device_id not in TOPOLOGY:
-        target_device_id = find_target_node_id(TOPOLOGY, keyword="L2_SW")
+        target_device_id = find_target_node_id(TOPOLOGY, keyword="L2_SW", index=NODE_INDEX)
     if target_device_id and target_device_id in TOPOLOGY:
-        child_nodes = [nid for nid, n in TOPOLOGY.items() if n.parent_id == target_device_id]
+        child_nodes = TOPO_CHILDREN.get(target_device_id, [])
         alarms = [Alarm(child, "Connection Lost", "CRITICAL") for child in child_nodes]
     else:
         st.error("Error: L2 Switch definition not found")
 
 elif "複合障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
+    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER", index=NODE_INDEX)
     if target_device_id:
         alarms = [
             Alarm(target_device_id, "Power Supply 1 Failed", "CRITICAL"),
             Alarm(target_device_id, "Fan Fail", "WARNING")
         ]
 elif "同時多発" in selected_scenario:
-    fw_node = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    ap_node = find_target_node_id(TOPOLOGY, node_type="ACCESS_POINT")
+    fw_node = find_target_node_id(TOPOLOGY, node_type="FIREWALL", index=NODE_INDEX)
+    ap_node = find_target_node_id(TOPOLOGY, node_type="ACCESS_POINT", index=NODE_INDEX)
     alarms = []
     if fw_node: alarms.append(Alarm(fw_node, "Heartbeat Loss", "WARNING"))
     if ap_node: alarms.append(Alarm(ap_node, "Connection Lost", "CRITICAL"))
     target_device_id = fw_node 
 else:
-    if "[WAN]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    elif "[FW]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    elif "[L2SW]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="SWITCH", layer=4)
-
-    if target_device_id:
-        if "電源障害：片系" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Power Supply 1 Failed", "WARNING")]
-            root_severity = "WARNING"
-        elif "電源障害：両系" in selected_scenario:
-            if "FW" in target_device_id:
-                alarms = [Alarm(target_device_id, "Power Supply: Dual Loss (Device Down)", "CRITICAL")]
+    spec = _device_fault_spec(selected_scenario)
+    if spec:
+        node_type, layer, fault = spec
+        target_device_id = find_target_node_id(TOPOLOGY, node_type=node_type, layer=layer, index=NODE_INDEX)
+
+        if target_device_id and fault:
+            message, severity = fault
+            if message == DUAL_PSU_LOSS:
+                if "FW" in target_device_id:
+                    alarms = [Alarm(target_device_id, DUAL_PSU_LOSS, "CRITICAL")]
+                else:
+                    alarms = _simulate_cascade(TOPOLOGY, target_device_id, DUAL_PSU_LOSS, TOPO_KEY)
             else:
-                alarms = simulate_cascade_failure(target_device_id, TOPOLOGY, "Power Supply: Dual Loss (Device Down)")
-        elif "BGP" in selected_scenario:
-            alarms = [Alarm(target_device_id, "BGP Flapping", "WARNING")]
-            root_severity = "WARNING"
-        elif "FAN" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Fan Fail", "WARNING")]
-            root_severity = "WARNING"
-        elif "メモリ" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Memory High", "WARNING")]
-            root_severity = "WARNING"
+                alarms = [Alarm(target_device_id, message, severity)]
+                root_severity = severity
 
 # 2. 推論エンジンによる分析
 # --- Silent failure 표현 강화: シナリオに応じてRCAエンジンの閾値を調整 ---
-engine = st.session_state.logic_engine
-# デフォルト（保守的）
-engine.SILENT_MIN_CHILDREN = getattr(engine, "SILENT_MIN_CHILDREN", 2) or 2
-engine.SILENT_RATIO = 0.5
+# デフォルト（保守的）は 0.5。
 # サイレント障害シナリオでは「少数端末の同時断」でも上位SWを疑えるよう感度を上げる
-if "サイレント" in selected_scenario:
-    engine.SILENT_RATIO = 0.3
-analysis_results = engine.analyze(alarms)
+silent_ratio = 0.3 if "サイレント" in selected_scenario else 0.5
+alarm_key = tuple((a.device_id, a.message, a.severity) for a in alarms)
+analysis_results = _analyze(
+    str(_paths.topology_path), topo_mtime, silent_ratio,
+    bool(os.environ.get("GOOGLE_API_KEY")), alarm_key, alarms,
+)
 # このスコープの状態（停止/要対応/注意/正常）
 scope_status = _status_from_alarms(selected_scenario, alarms)
 
@@ -687,51 +898,13 @@ st.markdown("### 🛡️ AIOps インシデント・コックピット")
 col1, col2, col3 = st.columns(3)
 with col1: st.metric("📉 ノイズ削減率", "98.5%", "高効率稼働中")
 with col2: st.metric("📨 処理アラーム数", f"{len(alarms) * 15 if alarms else 0}件", "抑制済")
-with col3: st.metric("🚨 要対応インシデント", f"{len([c for c in analysis_results if c['prob'] > 0.6])}件", "対処が必要")
+with col3: st.metric("🚨 要対応インシデント", f"{len([c for c in analysis_results if c.prob > 0.6])}件", "対処が必要")
 st.markdown("---")
 
-df_data = []
-# ★修正: スライス制限を撤廃 (全件表示)
-# 階層ロジックにより、重要なもの(Tier高)が先頭に来るため、大量にあっても問題ない
-for rank, cand in enumerate(analysis_results, 1):
-    status = "⚪ 監視中"
-    action = "👁️ 静観"
-
-    # サイレント障害の表現強化: 症状(端末)ではなく「上位設備の疑い」として強調
-    is_silent = ("SilentFailure" in str(cand.get("type","")) or "Silent" in str(cand.get("type","")) or "サイレント" in str(cand.get("type","")))
-    if is_silent:
-        status = "🟣 サイレント疑い (上位設備)"
-        action = "🔍 上位SW/配下影響を確認"
-    else:
-        if cand['prob'] > 0.8:
-            status = "🔴 危険 (根本原因)"
-            action = "🚀 自動修復が可能"
-        elif cand['prob'] > 0.6:
-            status = "🟡 警告 (被疑箇所)"
-            action = "🔍 詳細調査を推奨"
-
-    if "Network/Unreachable" in cand['type'] or "Network/Secondary" in cand['type']:
-        status = "⚫ 応答なし (上位障害)"
-        action = "⛔ 対応不要 (上位復旧待ち)"
-
-    candidate_text = f"デバイス: {cand['id']} / 原因: {cand['label']}"
-    if cand.get('verification_log'):
-        candidate_text += " [🔍 Active Probe: 応答なし]"
-    
-    # デバッグ用にTierを表示（本番では消しても良い）
-    # candidate_text += f" (Tier: {cand.get('tier')})"
-
-    df_data.append({
-        "順位": rank,
-        "ステータス": status,
-        "根本原因候補": candidate_text,
-        "リスクスコア": (None if scope_status == "停止" else cand['prob']),
-        "推奨アクション": action,
-        "ID": cand['id'],
-        "Type": cand['type']
-    })
-
-df = pd.DataFrame(df_data)
+df = _build_cockpit_df(
+    tuple((c.id, c.label, c.prob, c.type, bool(c.verification_log)) for c in analysis_results),
+    scope_status == "停止",
+)
 st.info("💡 ヒント: インシデントの行をクリックすると、右側に詳細分析と復旧プランが表示されます。")
 
 event = st.dataframe(
@@ -756,7 +929,7 @@ if len(event.selection.rows) > 0:
     idx = event.selection.rows[0]
     sel_row = df.iloc[idx]
     for res in analysis_results:
-        if res['id'] == sel_row['ID'] and res['type'] == sel_row['Type']:
+        if res.id == sel_row['ID'] and res.type == sel_row['Type']:
             selected_incident_candidate = res
             break
 else:
@@ -773,9 +946,9 @@ with col_map:
     current_root_node = None
     current_severity = "WARNING"
     
-    if selected_incident_candidate and selected_incident_candidate["prob"] > 0.6:
-        current_root_node = TOPOLOGY.get(selected_incident_candidate["id"])
-        if "Hardware/Physical" in selected_incident_candidate["type"] or "Critical" in selected_incident_candidate["type"] or "Silent" in selected_incident_candidate["type"]:
+    if selected_incident_candidate and selected_incident_candidate.prob > 0.6:
+        current_root_node = TOPOLOGY.get(selected_incident_candidate.id)
+        if "Hardware/Physical" in selected_incident_candidate.type or "Critical" in selected_incident_candidate.type or "Silent" in selected_incident_candidate.type:
             current_severity = "CRITICAL"
         else:
             current_severity = "WARNING"
@@ -784,7 +957,7 @@ with col_map:
         current_root_node = TOPOLOGY.get(target_device_id)
         current_severity = root_severity
 
-    st.graphviz_chart(render_topology(alarms, analysis_results), use_container_width=True)
+    st.graphviz_chart(render_topology(alarms, analysis_results, str(_paths.topology_path), topo_mtime), use_container_width=True)
 
     st.markdown("---")
     st.subheader("🛠️ Auto-Diagnostics")
@@ -797,7 +970,9 @@ with col_map:
                 st.write("🔌 Connecting to device...")
                 target_node_obj = TOPOLOGY.get(target_device_id) if target_device_id else None
                 
-                res = run_diagnostic_simulation(selected_scenario, target_node_obj, api_key)
+                # AI 生成ログはマスキングしながら届いた所まで表示する
+                log_view = st.empty()
+                res = run_diagnostic_simulation(selected_scenario, target_node_obj, api_key, on_log=log_view.code)
                 st.session_state.live_result = res
                 
                 if res["status"] == "SUCCESS":
@@ -819,9 +994,9 @@ with col_map:
         if res["status"] == "SUCCESS":
             st.markdown("#### 📄 Diagnostic Results")
             with st.container(border=True):
-                if selected_incident_candidate and selected_incident_candidate.get("verification_log"):
+                if selected_incident_candidate and selected_incident_candidate.verification_log:
                     st.caption("🤖 Active Probe / Verification Log")
-                    st.code(selected_incident_candidate["verification_log"], language="text")
+                    st.code(selected_incident_candidate.verification_log, language="text")
                     st.divider()
 
                 if st.session_state.verification_result:
@@ -846,18 +1021,17 @@ with col_chat:
         
         # --- A. 状況報告 (Situation Report) ---
         if "generated_report" not in st.session_state or st.session_state.generated_report is None:
-            st.info(f"インシデント選択中: **{cand['id']}** ({cand['label']})")
+            st.info(f"インシデント選択中: **{cand.id}** ({cand.label})")
             
             if api_key and selected_scenario != "正常稼働":
                 if st.button("📝 詳細レポートを作成 (Generate Report)"):
                     
                     report_container = st.empty()
-                    cfg = load_config_sanitized(cand['id'])
+                    cfg = load_config_sanitized(cand.id)
                     
-                    genai.configure(api_key=api_key)
-                    model = genai.GenerativeModel("gemma-3-12b-it")
+                    model = ai_manager.get_model(api_key, "gemma-3-12b-it")
                     
-                    verification_context = cand.get("verification_log", "特になし")
+                    verification_context = cand.verification_log or "特になし"
                     
                     prompt = f"""
                     あなたはネットワーク運用監視のプロフェッショナルです。
@@ -865,8 +1039,8 @@ with col_chat:
                     
                     【入力情報】
                     - 発生シナリオ: {selected_scenario}
-                    - 根本原因候補: {cand['id']} ({cand['label']})
-                    - リスクスコア: {"N/A（停止中のため評価対象外）" if scope_status=="停止" else f"{cand['prob']*100:.0f}"}
+                    - 根本原因候補: {cand.id} ({cand.label})
+                    - リスクスコア: {"N/A（停止中のため評価対象外）" if scope_status=="停止" else f"{cand.prob*100:.0f}"}
                     
                     【★重要: AIによる能動的診断結果 (Reasoning)】
                     システムはアラームだけでなく、以下の能動的な確認を行いました。この内容を「対応」や「特定根拠」に含めてください。
@@ -886,7 +1060,7 @@ with col_chat:
                     2. 見出し（###）の前後には必ず空行を入れてください。
                     
                     構成:
-                    ### 状況報告：{cand['id']}
+                    ### 状況報告：{cand.id}
                     
                     **1. 障害概要**
                     (概要記述)
@@ -919,7 +1093,7 @@ with col_chat:
                         
                         if not full_text: full_text = "レポート生成に失敗しました（空の応答）。"
                         st.session_state.generated_report = full_text
-                        st.session_state.last_report_cand_id = cand['id']
+                        st.session_state.last_report_cand_id = cand.id
                         
                     except Exception as e:
                         err_msg = f"Report Generation Error: {str(e)}"
@@ -935,12 +1109,12 @@ with col_chat:
     st.markdown("---")
     st.subheader("🤖 Remediation & Chat")
 
-    if selected_incident_candidate and selected_incident_candidate["prob"] > 0.6:
+    if selected_incident_candidate and selected_incident_candidate.prob > 0.6:
         st.markdown(f"""
         <div style="background-color:#e8f5e9;padding:10px;border-radius:5px;border:1px solid #4caf50;color:#2e7d32;margin-bottom:10px;">
             <strong>✅ AI Analysis Completed</strong><br>
-            特定された原因 <b>{selected_incident_candidate['id']}</b> に対する復旧手順が利用可能です。<br>
-            (リスクスコア: <span style="font-size:1.2em;font-weight:bold;">{selected_incident_candidate['prob']*100:.0f}</span>)
+            特定された原因 <b>{selected_incident_candidate.id}</b> に対する復旧手順が利用可能です。<br>
+            (リスクスコア: <span style="font-size:1.2em;font-weight:bold;">{selected_incident_candidate.prob*100:.0f}</span>)
         </div>
         """, unsafe_allow_html=True)
 
@@ -949,13 +1123,18 @@ with col_chat:
                  if not api_key: st.error("API Key Required")
                  else:
                     with st.spinner("Generating plan..."):
-                        t_node = TOPOLOGY.get(selected_incident_candidate["id"])
-                        plan_md = generate_remediation_commands(
+                        t_node = TOPOLOGY.get(selected_incident_candidate.id)
+                        # 手順書と復旧後の確認ログを1回の呼び出しでまとめて生成（確認ログは実行時に使う）
+                        # 手順書は生成されたところから逐次表示する
+                        plan_container = st.empty()
+                        bundle = generate_remediation_bundle(
                             selected_scenario, 
-                            f"Identified Root Cause: {selected_incident_candidate['label']}", 
-                            t_node, api_key
+                            f"Identified Root Cause: {selected_incident_candidate.label}", 
+                            t_node, api_key,
+                            on_plan=plan_container.markdown,
                         )
-                        st.session_state.remediation_plan = plan_md
+                        st.session_state.remediation_plan = bundle["plan"]
+                        st.session_state.remediation_verification = bundle["verification_log"]
                         st.rerun()
         
         if "remediation_plan" in st.session_state:
@@ -972,12 +1151,15 @@ with col_chat:
                     else:
                         with st.status("Autonomic Remediation in progress...", expanded=True) as status:
                             st.write("⚙️ Applying Configuration...")
-                            time.sleep(1.5) 
+                            started = time.monotonic()
                             
                             st.write("🔎 Running Verification Commands...")
-                            target_node_obj = TOPOLOGY.get(selected_incident_candidate["id"])
-                            verification_log = generate_fake_log_by_ai("正常稼働", target_node_obj, api_key)
+                            verification_log = st.session_state.get("remediation_verification")
+                            if not verification_log:
+                                target_node_obj = TOPOLOGY.get(selected_incident_candidate.id)
+                                verification_log = generate_fake_log_by_ai("正常稼働", target_node_obj, api_key)
                             st.session_state.verification_log = verification_log
+                            demo_pace(started)  # 演出の待ちは確認ログ取得と重ねる
                             
                             st.write("✅ Verification Completed.")
                             status.update(label="Process Finished", state="complete", expanded=False)
@@ -987,6 +1169,7 @@ with col_chat:
             with col_exec2:
                  if st.button("キャンセル"):
                     del st.session_state.remediation_plan
+                    st.session_state.remediation_verification = None
                     st.session_state.verification_log = None
                     st.rerun()
             
@@ -1004,12 +1187,13 @@ with col_chat:
 
                 if st.button("デモを終了してリセット"):
                     del st.session_state.remediation_plan
+                    st.session_state.remediation_verification = None
                     st.session_state.verification_log = None
                     st.session_state.current_scenario = "正常稼働"
                     st.rerun()
     else:
         if selected_incident_candidate:
-            score = (None if scope_status == "停止" else selected_incident_candidate['prob'] * 100)
+            score = (None if scope_status == "停止" else selected_incident_candidate.prob * 100)
             st.warning(f"""
             ⚠️ **自動修復はロックされています**
             現在選択されているインシデントのリスクスコアは **{('N/A（停止中のため評価対象外）' if score is None else f'{score:.0f}')}** です。
@@ -1019,8 +1203,7 @@ with col_chat:
     # チャット (常時表示)
     with st.expander("💬 Chat with AI Agent", expanded=False):
         if st.session_state.chat_session is None and api_key and selected_scenario != "正常稼働":
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel("gemma-3-12b-it")
+            model = ai_manager.get_model(api_key, "gemma-3-12b-it")
             st.session_state.chat_session = model.start_chat(history=[])
 
         for msg in st.session_state.messages:
@@ -6,9 +6,16 @@ Google Antigravity AIOps Agent - Data Module (Optimized Final)
 import json
 import os
 import logging
-from typing import Dict, Optional, Any
+from functools import lru_cache
+from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, field
 
+# orjson があれば JSON パースに使う（無ければ標準の json）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # =====================================================
 # ロギング設定
 # =====================================================
@@ -26,7 +33,7 @@ class TopologyConstants:
 # =====================================================
 # データクラス定義
 # =====================================================
-@dataclass
+@dataclass(slots=True)
 class NetworkNode:
     """ネットワークノードを表現するデータクラス"""
     id: str
@@ -96,16 +103,26 @@ DEFAULT_RAW_DATA = {
 # =====================================================
 # トポロジー読み込み関数
 # =====================================================
+def _read_json_file(filename: str) -> Any:
+    """JSONファイルを読む（orjson が入っていれば使い、読めない形式なら標準の json で読み直す）"""
+    if orjson is None:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data.decode('utf-8'))
+
 def load_topology_from_json(filename: str = TopologyConstants.DEFAULT_TOPOLOGY_FILE) -> Dict[str, NetworkNode]:
     """JSONファイルからトポロジーを読み込み"""
-    topology = {}
     raw_data = {}
 
     # ファイル読み込み試行
     if os.path.exists(filename):
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                raw_data = json.load(f)
+            raw_data = _read_json_file(filename)
             logger.info(f"Loaded topology from {filename}")
         except Exception as e:
             logger.error(f"Error loading {filename}: {e}. Using default data.")
@@ -114,6 +131,12 @@ def load_topology_from_json(filename: str = TopologyConstants.DEFAULT_TOPOLOGY_F
         logger.info(f"{filename} not found. Using default data.")
         raw_data = DEFAULT_RAW_DATA
 
+    return load_topology_from_json_obj(raw_data)
+
+def load_topology_from_json_obj(raw_data: Dict[str, Any]) -> Dict[str, NetworkNode]:
+    """パース済みのトポロジー JSON（dict）から NetworkNode を組み立てる"""
+    topology = {}
+
     # オブジェクト変換
     for key, value in raw_data.items():
         try:
@@ -177,6 +200,34 @@ def _has_circular_reference(node: NetworkNode, topology: Dict[str, NetworkNode],
     return False
 
 # =====================================================
-# グローバル変数
+# 索引（読み込み後に1回だけ作り、O(N) 走査の繰り返しを避ける）
 # =====================================================
-TOPOLOGY = load_topology_from_json()
+def build_children_index(topology: Dict[str, NetworkNode]) -> Dict[str, List[str]]:
+    """parent_id -> 子ノードIDのリスト（トポロジー定義順）"""
+    index: Dict[str, List[str]] = {}
+    for node_id, node in topology.items():
+        if node.parent_id:
+            index.setdefault(node.parent_id, []).append(node_id)
+    return index
+
+def build_redundancy_index(topology: Dict[str, NetworkNode]) -> Dict[str, List[str]]:
+    """redundancy_group -> メンバーノードIDのリスト（トポロジー定義順）"""
+    index: Dict[str, List[str]] = {}
+    for node_id, node in topology.items():
+        if node.redundancy_group:
+            index.setdefault(node.redundancy_group, []).append(node_id)
+    return index
+
+# =====================================================
+# グローバル変数（初回アクセス時に1回だけ読み込む）
+# =====================================================
+@lru_cache(maxsize=1)
+def get_topology() -> Dict[str, NetworkNode]:
+    """既定トポロジー（プロセス内で共有。呼び出し側で変更しないこと）"""
+    return load_topology_from_json()
+
+def __getattr__(name: str) -> Any:
+    # 互換性維持: data.TOPOLOGY は import 時ではなく参照時に読み込む
+    if name == "TOPOLOGY":
+        return get_topology()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
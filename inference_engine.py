@@ -1,10 +1,11 @@
 import json
 import os
 import re
+from dataclasses import dataclass
 from enum import Enum
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 
-import google.generativeai as genai
+from ai_client import ai_manager, parse_json_response
 
 # ==========================================================
 # AIOps health status
@@ -15,6 +16,44 @@ class HealthStatus(Enum):
     CRITICAL = "RED"
 
 
+@dataclass(slots=True)
+class Candidate:
+    """analyze() が返す被疑候補1件"""
+    id: str
+    label: str
+    prob: float
+    type: str
+    tier: int
+    reason: str
+    analyst_report: Optional[str] = None
+    auto_investigation: Optional[List[str]] = None
+    verification_log: Optional[str] = None
+
+
+# 子の疎通断シグネチャ（大文字小文字無視の単一パターンで判定）
+_CONNECTION_LOSS_RE = re.compile(r"connection lost|link down|port down|unreachable", re.IGNORECASE)
+# 小文字化済みの本文（Alarm.lower）用。大文字小文字の畳み込みが不要なぶん速い
+_CONNECTION_LOSS_LOWER_RE = re.compile(r"connection lost|link down|port down|unreachable")
+
+# ローカル安全ルールのキーワード（停止系のみ大文字小文字を区別、それ以外は小文字化した本文に対して判定）
+_DOWN_KEYWORDS = ("Power Supply: Dual Loss", "Dual Loss", "Device Down", "Thermal Shutdown")
+_OVERHEAT_KEYWORDS = ("high temperature", "overheat", "thermal")
+_OOM_KEYWORDS = ("out of memory", "oom", "killed process", "kernel panic")
+_RULE_KEYWORDS = (
+    "power supply", "failed", "dual", "psu", "fail",
+    "fan fail", "fan",
+    "memory high", "memory leak", "memory", "leak", "high",
+) + _OVERHEAT_KEYWORDS + _OOM_KEYWORDS
+
+# 判定ステータス -> (prob, tier)。表に無いもの（NORMAL 等）は _DEFAULT_SCORE
+_STATUS_SCORE = {
+    HealthStatus.CRITICAL: (0.9, 1),
+    HealthStatus.WARNING: (0.7, 2),
+}
+_DEFAULT_SCORE = (0.3, 3)
+_NO_API_SCORE = (0.5, 3)
+
+
 class LogicalRCA:
     """
     LogicalRCA (v5):
@@ -117,8 +156,7 @@ class LogicalRCA:
         if not api_key:
             return False
         try:
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel("gemini-1.5-flash")
+            self.model = ai_manager.get_model(api_key, "gemini-1.5-flash")
             self._api_configured = True
             return True
         except Exception as e:
@@ -158,31 +196,22 @@ class LogicalRCA:
     # Silent failure inference
     # ==========================================================
     def _is_connection_loss(self, msg: str) -> bool:
-        msg_l = msg.lower()
-        return (
-            "connection lost" in msg_l
-            or "link down" in msg_l
-            or "port down" in msg_l
-            or "unreachable" in msg_l
-        )
-
-    def _detect_silent_failures(self, msg_map: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
+        return _CONNECTION_LOSS_RE.search(msg) is not None
+
+    def _detect_silent_failures(self, alarmed_ids: Set[str], lost_ids: Set[str]) -> Dict[str, Dict[str, Any]]:
         """
         親自身にアラームが無いのに、配下の複数子が Connection Lost を出しているなら親を疑う。
+        lost_ids は analyze のアラーム走査で求めた「接続断を出した機器」の集合。
         """
         suspects: Dict[str, Dict[str, Any]] = {}
 
         for parent_id, children in self.children_map.items():
             if not children:
                 continue
-            if parent_id in msg_map:
+            if parent_id in alarmed_ids:
                 continue
 
-            affected = []
-            for c in children:
-                msgs = msg_map.get(c, [])
-                if any(self._is_connection_loss(m) for m in msgs):
-                    affected.append(c)
+            affected = [c for c in children if c in lost_ids]
 
             if not affected:
                 continue
@@ -215,23 +244,35 @@ class LogicalRCA:
     # ==========================================================
     # Public API
     # ==========================================================
-    def analyze(self, alarms: List) -> List[Dict[str, Any]]:
+    def analyze(self, alarms: List) -> List[Candidate]:
         if not alarms:
-            return [{
-                "id": "SYSTEM",
-                "label": "No alerts detected",
-                "prob": 0.0,
-                "type": "Normal",
-                "tier": 0,
-                "reason": "No active alerts detected."
-            }]
-
+            return [Candidate(
+                id="SYSTEM",
+                label="No alerts detected",
+                prob=0.0,
+                type="Normal",
+                tier=0,
+                reason="No active alerts detected.",
+            )]
+
+        # アラームの走査は1回だけ：機器ごとのメッセージと、接続断/到達不能を出した機器を同時に集める
+        # （小文字化はアラーム生成時の1回（Alarm.lower）で済ませている）
         msg_map: Dict[str, List[str]] = {}
+        lost_ids: Set[str] = set()
+        unreachable_ids: Set[str] = set()
         for a in alarms:
             msg_map.setdefault(a.device_id, []).append(a.message)
-
-        # サイレント推定
-        silent_suspects = self._detect_silent_failures(msg_map)
+            lowered = getattr(a, "lower", None) or a.message.lower()
+            if _CONNECTION_LOSS_LOWER_RE.search(lowered):
+                lost_ids.add(a.device_id)
+                if "unreachable" in lowered:
+                    unreachable_ids.add(a.device_id)
+
+        # サイレント推定（接続断を出した機器数が閾値未満なら成立し得ないので走査しない）
+        if len(lost_ids) >= self.SILENT_MIN_CHILDREN:
+            silent_suspects = self._detect_silent_failures(set(msg_map), lost_ids)
+        else:
+            silent_suspects = {}
 
         # 親を分析対象に追加（疑似アラーム）
         for parent_id, info in silent_suspects.items():
@@ -247,82 +288,72 @@ class LogicalRCA:
             p = self._get_parent_id(dev)
             return bool(p and (p in silent_suspects))
 
-        results: List[Dict[str, Any]] = []
+        results: List[Candidate] = []
 
         for device_id, messages in msg_map.items():
-
             # サイレント疑い配下の子は被疑（症状）扱い
-            if parent_is_silent_suspect(device_id) and any(self._is_connection_loss(m) for m in messages):
+            if parent_is_silent_suspect(device_id) and device_id in lost_ids:
                 p = self._get_parent_id(device_id)
-                results.append({
-                    "id": device_id,
-                    "label": " / ".join(messages),
-                    "prob": 0.4,
-                    "type": "Network/ConnectionLost",
-                    "tier": 3,
-                    "reason": f"Downstream symptom under suspected silent failure parent (parent={p})."
-                })
+                results.append(Candidate(
+                    id=device_id,
+                    label=" / ".join(messages),
+                    prob=0.4,
+                    type="Network/ConnectionLost",
+                    tier=3,
+                    reason=f"Downstream symptom under suspected silent failure parent (parent={p})."
+                ))
                 continue
 
             # 通常のカスケード抑制
-            if any("unreachable" in m.lower() for m in messages) and parent_is_alarmed(device_id):
+            if device_id in unreachable_ids and parent_is_alarmed(device_id):
                 p = self._get_parent_id(device_id)
-                results.append({
-                    "id": device_id,
-                    "label": " / ".join(messages),
-                    "prob": 0.2,
-                    "type": "Network/Unreachable",
-                    "tier": 3,
-                    "reason": f"Downstream unreachable due to upstream alarm (parent={p})."
-                })
+                results.append(Candidate(
+                    id=device_id,
+                    label=" / ".join(messages),
+                    prob=0.2,
+                    type="Network/Unreachable",
+                    tier=3,
+                    reason=f"Downstream unreachable due to upstream alarm (parent={p})."
+                ))
                 continue
 
             # 親がサイレント疑いの場合：黄色・高優先度で出す（赤にしない）
             if device_id in silent_suspects:
                 info = silent_suspects[device_id]
-                results.append({
-                    "id": device_id,
-                    "label": " / ".join(messages),
-                    "prob": 0.8,
-                    "type": "Network/SilentFailure",
-                    "tier": 1,
-                    "reason": f"Silent failure suspected: {info['evidence_count']}/{info['total_children']} children affected.",
-                    "analyst_report": info["report"],
-                    "auto_investigation": [
+                results.append(Candidate(
+                    id=device_id,
+                    label=" / ".join(messages),
+                    prob=0.8,
+                    type="Network/SilentFailure",
+                    tier=1,
+                    reason=f"Silent failure suspected: {info['evidence_count']}/{info['total_children']} children affected.",
+                    analyst_report=info["report"],
+                    auto_investigation=[
                         "Pull interface counters/errors (uplinks)",
                         "Check STP/MAC flaps",
                         "Ping/ARP reachability tests from upstream",
                         "Correlate syslog around incident time"
                     ]
-                })
+                ))
                 continue
 
             analysis = self.analyze_redundancy_depth(device_id, messages)
 
             if analysis.get("impact_type") == "UNKNOWN" and "API key not configured" in analysis.get("reason", ""):
-                prob = 0.5
-                tier = 3
+                prob, tier = _NO_API_SCORE
             else:
-                if analysis["status"] == HealthStatus.CRITICAL:
-                    prob = 0.9
-                    tier = 1
-                elif analysis["status"] == HealthStatus.WARNING:
-                    prob = 0.7
-                    tier = 2
-                else:
-                    prob = 0.3
-                    tier = 3
-
-            results.append({
-                "id": device_id,
-                "label": " / ".join(messages),
-                "prob": prob,
-                "type": analysis.get("impact_type", "UNKNOWN"),
-                "tier": tier,
-                "reason": analysis.get("reason", "AI provided no reason")
-            })
-
-        results.sort(key=lambda x: x["prob"], reverse=True)
+                prob, tier = _STATUS_SCORE.get(analysis["status"], _DEFAULT_SCORE)
+
+            results.append(Candidate(
+                id=device_id,
+                label=" / ".join(messages),
+                prob=prob,
+                type=analysis.get("impact_type", "UNKNOWN"),
+                tier=tier,
+                reason=analysis.get("reason", "AI provided no reason")
+            ))
+
+        results.sort(key=lambda x: x.prob, reverse=True)
         return results
 
     # ==========================================================
@@ -347,29 +378,32 @@ class LogicalRCA:
         joined = " ".join(safe_alerts)
         joined_lower = joined.lower()
 
+        # キーワードの出現は1回だけ調べ、以降のルールは集合の参照で判定する
+        hits = {k for k in _RULE_KEYWORDS if k in joined_lower}
+
         # 0) 停止系（赤）
-        if ("Power Supply: Dual Loss" in joined) or ("Dual Loss" in joined) or ("Device Down" in joined) or ("Thermal Shutdown" in joined):
+        if any(k in joined for k in _DOWN_KEYWORDS):
             return {"status": HealthStatus.CRITICAL, "reason": "Device down / dual PSU loss / thermal shutdown detected (local safety rule).", "impact_type": "Hardware/Physical"}
 
         # 1) 電源片系（黄色/赤）
-        psu_count = self._get_psu_count(device_id, default=1)
-        psu_single_fail = ("power supply" in joined_lower and "failed" in joined_lower and "dual" not in joined_lower) or ("psu" in joined_lower and "fail" in joined_lower and "dual" not in joined_lower)
+        psu_single_fail = "dual" not in hits and (("power supply" in hits and "failed" in hits) or ("psu" in hits and "fail" in hits))
         if psu_single_fail:
+            psu_count = self._get_psu_count(device_id, default=1)
             if psu_count >= 2:
                 return {"status": HealthStatus.WARNING, "reason": f"Single PSU failure with redundancy (psu_count={psu_count}) (local safety rule).", "impact_type": "Hardware/Redundancy"}
             return {"status": HealthStatus.CRITICAL, "reason": f"Single PSU failure without redundancy (psu_count={psu_count}) (local safety rule).", "impact_type": "Hardware/Physical"}
 
         # 2) FAN（黄色 / 熱兆候で赤）
-        fan_fail = ("fan fail" in joined_lower) or ("fan" in joined_lower and "fail" in joined_lower)
-        overheat_hint = ("high temperature" in joined_lower) or ("overheat" in joined_lower) or ("thermal" in joined_lower)
+        fan_fail = ("fan fail" in hits) or ("fan" in hits and "fail" in hits)
+        overheat_hint = not hits.isdisjoint(_OVERHEAT_KEYWORDS)
         if fan_fail:
             if overheat_hint:
                 return {"status": HealthStatus.CRITICAL, "reason": "Fan failure with overheat/thermal symptom detected (local safety rule).", "impact_type": "Hardware/Physical"}
             return {"status": HealthStatus.WARNING, "reason": "Fan failure detected. Service likely continues but risk of thermal escalation (local safety rule).", "impact_type": "Hardware/Degraded"}
 
         # 3) メモリ（黄色 / OOMで赤）
-        mem_symptom = ("memory high" in joined_lower) or ("memory leak" in joined_lower) or ("memory" in joined_lower and ("leak" in joined_lower or "high" in joined_lower))
-        oom_hint = ("out of memory" in joined_lower) or ("oom" in joined_lower) or ("killed process" in joined_lower) or ("kernel panic" in joined_lower)
+        mem_symptom = ("memory high" in hits) or ("memory leak" in hits) or ("memory" in hits and ("leak" in hits or "high" in hits))
+        oom_hint = not hits.isdisjoint(_OOM_KEYWORDS)
         if mem_symptom:
             if oom_hint:
                 return {"status": HealthStatus.CRITICAL, "reason": "Memory leak/high with OOM/crash symptom detected (local safety rule).", "impact_type": "Software/Resource"}
@@ -412,12 +446,7 @@ class LogicalRCA:
 
         try:
             response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            result_json = json.loads(response_text)
+            result_json = parse_json_response(response.text)
 
             status_str = str(result_json.get("status", "CRITICAL")).upper()
             if status_str in ["GREEN", "NORMAL"]:
@@ -5,9 +5,11 @@ Google Antigravity AIOps Agent - Logic Module (Optimized Final)
 """
 
 import logging
+from collections import deque
 from typing import List, Dict, Set, Optional
 from dataclasses import dataclass, field
-from data import TOPOLOGY, NetworkNode
+from data import NetworkNode, build_children_index, build_redundancy_index
+from data import validate_topology as _validate_topology
 
 # =====================================================
 # ロギング設定
@@ -18,7 +20,7 @@ logger = logging.getLogger(__name__)
 # データクラス定義
 # =====================================================
 
-@dataclass
+@dataclass(slots=True)
 class Alarm:
     """
     ネットワークアラームを表現するデータクラス
@@ -27,9 +29,12 @@ class Alarm:
     message: str
     severity: str  # CRITICAL, WARNING, INFO
     timestamp: Optional[float] = None
+    # message の小文字形（生成時に1回だけ計算。キーワード判定で使い回す）
+    lower: str = field(init=False, repr=False, compare=False)
     
     def __post_init__(self):
         """バリデーション"""
+        self.lower = self.message.lower()
         valid_severities = {"CRITICAL", "WARNING", "INFO"}
         if self.severity not in valid_severities:
             logger.warning(
@@ -41,7 +46,7 @@ class Alarm:
         if not self.device_id or not isinstance(self.device_id, str):
             raise ValueError(f"Invalid device_id: {self.device_id}")
 
-@dataclass
+@dataclass(slots=True)
 class InferenceResult:
     """
     因果推論の結果を表現するデータクラス
@@ -76,6 +81,12 @@ class CausalInferenceEngine:
             raise ValueError("Topology cannot be empty")
         
         self.topology = topology
+        self.children_index = build_children_index(topology)
+        self.redundancy_index = build_redundancy_index(topology)
+        # 属性参照を避けるための ID -> layer / parent_id / redundancy_group
+        self._layer = {nid: n.layer for nid, n in topology.items()}
+        self._parent = {nid: n.parent_id for nid, n in topology.items()}
+        self._redundancy = {nid: n.redundancy_group for nid, n in topology.items()}
         logger.info(f"CausalInferenceEngine initialized with {len(topology)} nodes")
     
     def analyze_alarms(self, alarms: List[Alarm]) -> InferenceResult:
@@ -100,17 +111,9 @@ class CausalInferenceEngine:
         alarmed_device_ids = {a.device_id for a in alarms}
         alarm_map = {a.device_id: a for a in alarms}
         
-        # 階層順にソート（layer値が小さいほど上位層）
-        sorted_alarms = sorted(
-            alarms,
-            key=lambda a: (
-                self.topology[a.device_id].layer 
-                if a.device_id in self.topology 
-                else 999
-            )
-        )
-        
-        top_alarm = sorted_alarms[0]
+        # 最上位層のアラームを1パスで選ぶ（layer値が小さいほど上位層。同層なら先勝ちでソート時と同じ）
+        layer_of = self._layer
+        top_alarm = min(alarms, key=lambda a: layer_of.get(a.device_id, 999))
         top_node = self.topology.get(top_alarm.device_id)
         
         # トポロジーに存在しないデバイス
@@ -125,13 +128,14 @@ class CausalInferenceEngine:
             )
         
         # A. 冗長性ルール（HA構成の分析）
-        if top_node.redundancy_group:
+        if self._redundancy[top_node.id]:
             return self._analyze_redundancy(top_node, alarmed_device_ids, alarms, alarm_map)
         
         # B. サイレント障害推論
-        if top_node.parent_id:
+        parent_id = self._parent[top_node.id]
+        if parent_id:
             silent_res = self._check_silent_failure_for_parent(
-                top_node.parent_id, 
+                parent_id, 
                 alarmed_device_ids
             )
             if silent_res:
@@ -160,8 +164,7 @@ class CausalInferenceEngine:
     ) -> InferenceResult:
         """冗長性構成（HA）の分析"""
         group_members = [
-            n for n in self.topology.values() 
-            if n.redundancy_group == node.redundancy_group
+            self.topology[nid] for nid in self.redundancy_index.get(node.redundancy_group, ())
         ]
         down_members = [n for n in group_members if n.id in alarmed_ids]
         
@@ -206,10 +209,10 @@ class CausalInferenceEngine:
         parent_node = self.topology.get(parent_id)
         if not parent_node: return None
         
-        children = [n for n in self.topology.values() if n.parent_id == parent_id]
+        children = self.children_index.get(parent_id, ())
         if not children: return None
         
-        children_down = sum(1 for c in children if c.id in alarmed_ids)
+        children_down = sum(1 for cid in children if cid in alarmed_ids)
         
         if children_down == len(children):
             return InferenceResult(
@@ -243,23 +246,20 @@ def simulate_cascade_failure(
     root_alarm = Alarm(root_cause_id, custom_message, "CRITICAL")
     generated_alarms.append(root_alarm)
     
-    # BFSで子デバイスを探索
-    queue = [root_cause_id]
+    # BFSで子デバイスを探索（親->子 索引は1回だけ作る）
+    children_index = build_children_index(topology)
+    queue = deque([root_cause_id])
     processed = {root_cause_id}
     
     while queue:
-        current_parent_id = queue.pop(0)
-        children = [
-            n for n in topology.values() 
-            if n.parent_id == current_parent_id
-        ]
+        current_parent_id = queue.popleft()
         
-        for child in children:
-            if child.id not in processed:
-                child_alarm = Alarm(child.id, "Unreachable", "WARNING")
+        for child_id in children_index.get(current_parent_id, ()):
+            if child_id not in processed:
+                child_alarm = Alarm(child_id, "Unreachable", "WARNING")
                 generated_alarms.append(child_alarm)
-                queue.append(child.id)
-                processed.add(child.id)
+                queue.append(child_id)
+                processed.add(child_id)
                 
     return generated_alarms
 
@@ -268,23 +268,6 @@ def simulate_cascade_failure(
 # =====================================================
 
 def validate_topology(topology: Dict[str, NetworkNode]) -> bool:
-    """トポロジーの整合性をチェック"""
+    """トポロジーの整合性をチェック（チェック本体は data.validate_topology に一本化）"""
     if not topology: return False
-    
-    issues = []
-    for node_id, node in topology.items():
-        if node.id != node_id:
-            issues.append(f"Node ID mismatch: {node_id}")
-        if node.parent_id and node.parent_id not in topology:
-            issues.append(f"Node {node_id} has invalid parent: {node.parent_id}")
-            
-    if issues:
-        for i in issues: logger.warning(i)
-        return False
-    return True
-
-# 初期化時にバリデーション実行
-try:
-    if TOPOLOGY: validate_topology(TOPOLOGY)
-except Exception as e:
-    logger.error(f"Topology validation error: {e}")
+    return _validate_topology(topology)
@@ -1,5 +1,6 @@
-import pandas as pd
-import random
+import csv
+
+import numpy as np
 
 # 生成するデータ数
 NUM_SAMPLES = 6000 
@@ -81,37 +82,63 @@ SCENARIOS = [
     }
 ]
 
+# シナリオ選択用の累積重み（一様乱数 × 総和 を二分探索してシナリオ番号にする）
+CUM_WEIGHTS = np.cumsum([s["weight"] for s in SCENARIOS])
+
+# L2_SW シナリオでは根本原因の機器をこの中からランダムに選ぶ（APも混ぜる）
+L2_SW_DEVICES = ["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]
+# どのシナリオにも一定確率で混ぜるノイズ
+NOISE_EVIDENCE = ("log", "Unknown Error")
+NOISE_PROB = 0.05
+
+def _build_tables():
+    """
+    シナリオ定義を固定順の配列に展開する。
+      prob[s, j]      : シナリオ s の j 番目の証拠が出る確率（末尾列はノイズ、未使用枠は 0）
+      ev_type/ev_val  : 同じ並びの証拠種別・値
+      root_keys[s, k] : シナリオ s で k 番目の機器が選ばれた時の RootCause
+    """
+    max_ev = max(len(s["probabilities"]) for s in SCENARIOS) + 1
+    n = len(SCENARIOS)
+    prob = np.zeros((n, max_ev))
+    ev_type = np.full((n, max_ev), "", dtype=object)
+    ev_val = np.full((n, max_ev), "", dtype=object)
+    root_keys = np.empty((n, len(L2_SW_DEVICES)), dtype=object)
+    for i, scenario in enumerate(SCENARIOS):
+        for j, ((t, v), p) in enumerate(scenario["probabilities"].items()):
+            prob[i, j], ev_type[i, j], ev_val[i, j] = p, t, v
+        prob[i, -1] = NOISE_PROB
+        ev_type[i, -1], ev_val[i, -1] = NOISE_EVIDENCE
+        r_ids = L2_SW_DEVICES if scenario["root_cause_id"] == "L2_SW" else [scenario["root_cause_id"]] * len(L2_SW_DEVICES)
+        root_keys[i] = [f"{r_id}::{scenario['root_cause_type']}" for r_id in r_ids]
+    return prob, ev_type, ev_val, root_keys
+
 def generate_mock_data():
-    data = []
     print(f"Generating {NUM_SAMPLES} training samples based on World Model...")
-    
-    for _ in range(NUM_SAMPLES):
-        scenario = random.choices(SCENARIOS, weights=[s["weight"] for s in SCENARIOS])[0]
-        
-        r_id = scenario['root_cause_id']
-        if r_id == "L2_SW":
-            r_id = random.choice(["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]) # APも混ぜる
-            
-        root_key = f"{r_id}::{scenario['root_cause_type']}"
-        
-        for (ev_type, ev_val), prob in scenario["probabilities"].items():
-            if random.random() < prob:
-                data.append({
-                    "RootCause": root_key,
-                    "EvidenceType": ev_type,
-                    "EvidenceValue": ev_val
-                })
-        
-        if random.random() < 0.05:
-            data.append({
-                "RootCause": root_key,
-                "EvidenceType": "log",
-                "EvidenceValue": "Unknown Error"
-            })
+    rng = np.random.default_rng()
+    prob, ev_type, ev_val, root_keys = _build_tables()
+
+    # サンプルごとのシナリオ・機器・証拠の有無を一括で引く
+    scen_idx = np.searchsorted(CUM_WEIGHTS, rng.random(NUM_SAMPLES) * CUM_WEIGHTS[-1], side="right")
+    np.minimum(scen_idx, len(SCENARIOS) - 1, out=scen_idx)  # 丸めで総和ちょうどになった場合の保険
+    dev_idx = rng.integers(len(L2_SW_DEVICES), size=NUM_SAMPLES)
+    mask = rng.random((NUM_SAMPLES, prob.shape[1])) < prob[scen_idx]
+
+    # 行優先の nonzero なので、サンプル順・証拠の定義順（ノイズは最後）に並ぶ
+    rows, slots = np.nonzero(mask)
+    scen_rows = scen_idx[rows]
+    columns = (
+        root_keys[scen_rows, dev_idx[rows]],
+        ev_type[scen_rows, slots],
+        ev_val[scen_rows, slots],
+    )
 
-    df = pd.DataFrame(data)
-    df.to_csv("training_data.csv", index=False)
-    print(f"✅ Saved 'training_data.csv' ({len(df)} records).")
+    # 列配列をそのまま csv.writer に流す（DataFrame を経由しない）
+    with open("training_data.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["RootCause", "EvidenceType", "EvidenceValue"])
+        writer.writerows(zip(*(c.tolist() for c in columns)))
+    print(f"✅ Saved 'training_data.csv' ({len(rows)} records).")
 
 if __name__ == "__main__":
     generate_mock_data()
@@ -5,8 +5,38 @@ import re
 import os
 import time
 import json
-import google.generativeai as genai
-from netmiko import ConnectHandler
+import hashlib
+import shelve
+import threading
+import textwrap
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from string import Template
+
+from ai_client import ai_manager as _ai_manager, parse_json_response
+from ai_retry import ai_call_retry, ai_rate_limiter, env_int, is_capacity_error
+
+def _env_seconds(name, default=0.0):
+    try:
+        return max(0.0, float(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+# デモ演出用の「処理している感」の待ち時間（秒）。既定 0 で待たない。展示でテンポを付けたい時だけ指定する
+# （AIOPS_DEMO_PACING。旧名 DEMO_PACING も読む）
+DEMO_PACING = _env_seconds("AIOPS_DEMO_PACING", _env_seconds("DEMO_PACING"))
+
+def demo_pace(started_at=None):
+    """
+    演出用に待つ。started_at（time.monotonic()）を渡すと、そこからの経過時間を差し引いた残りだけ待つ
+    （実処理と待ち時間を重ね、実処理が長ければ待たない）。
+    """
+    wait = DEMO_PACING
+    if started_at is not None:
+        wait -= time.monotonic() - started_at
+    if wait > 0:
+        time.sleep(wait)
 
 SANDBOX_DEVICE = {
     'device_type': 'cisco_nxos',
@@ -19,57 +49,397 @@ SANDBOX_DEVICE = {
     'conn_timeout': 30,
 }
 
+class SSHPool:
+    """
+    Live 診断用の SSH セッションを (host, username, port) 単位で使い回すプール。
+    接続・認証は初回のみ。再利用前に is_alive() で生存確認し、切れていれば張り直す。
+    Netmiko のセッションはスレッドセーフではないので、利用中は接続先ごとのロックを保持する。
+    プール全体のロック（_lock）は辞書の参照・更新の間だけ持ち、接続や利用中は持たない（他の接続先や掃除を止めない）。
+    IDLE_TTL 秒使われなかったセッションは、バックグラウンドの掃除スレッドが切断する（サンドボックス側の枠を占有しない）。
+    """
+    IDLE_TTL = _env_seconds("AIOPS_SSH_IDLE_TTL", 300.0)
+    _lock = threading.Lock()
+    _key_locks = {}
+    _conns = {}
+    _last_used = {}
+    _reaper = None
+
+    @staticmethod
+    def _key(device):
+        return (device.get('host'), device.get('username'), device.get('port', 22))
+
+    @classmethod
+    @contextmanager
+    def session(cls, device):
+        key = cls._key(device)
+        with cls._lock:
+            key_lock = cls._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with cls._lock:
+                ssh = cls._conns.get(key)
+            if ssh is not None:
+                try:
+                    alive = ssh.is_alive()
+                except Exception:
+                    alive = False
+                if not alive:
+                    with cls._lock:
+                        cls._conns.pop(key, None)
+                    cls._close(ssh)
+                    ssh = None
+            if ssh is None:
+                from netmiko import ConnectHandler  # 遅延 import（Live 診断時のみ paramiko 等を読み込む）
+                ssh = ConnectHandler(**device)
+                with cls._lock:
+                    cls._conns[key] = ssh
+                    cls._start_reaper()
+            try:
+                yield ssh
+            except Exception:
+                # 途中で失敗したセッションは捨て、次回は接続し直す
+                with cls._lock:
+                    cls._conns.pop(key, None)
+                    cls._last_used.pop(key, None)
+                cls._close(ssh)
+                raise
+            finally:
+                with cls._lock:
+                    if key in cls._conns:
+                        cls._last_used[key] = time.monotonic()
+
+    @classmethod
+    def _start_reaper(cls):
+        """掃除スレッドを1本だけ起動する（呼び出し側で _lock を保持）"""
+        if cls.IDLE_TTL <= 0 or (cls._reaper is not None and cls._reaper.is_alive()):
+            return
+        cls._reaper = threading.Thread(target=cls._reap_loop, name="ssh-pool-reaper", daemon=True)
+        cls._reaper.start()
+
+    @classmethod
+    def _reap_loop(cls):
+        interval = max(1.0, min(60.0, cls.IDLE_TTL / 2))
+        while True:
+            time.sleep(interval)
+            idle = []
+            with cls._lock:
+                now = time.monotonic()
+                for key in [k for k, t in cls._last_used.items() if now - t >= cls.IDLE_TTL]:
+                    # 利用中（接続先ロックが取れない）セッションには触らない
+                    key_lock = cls._key_locks.get(key)
+                    if key_lock is None or not key_lock.acquire(blocking=False):
+                        continue
+                    try:
+                        cls._last_used.pop(key, None)
+                        ssh = cls._conns.pop(key, None)
+                    finally:
+                        key_lock.release()
+                    if ssh is not None:
+                        idle.append(ssh)
+                stop = not cls._conns
+                if stop:
+                    # 空になったら終了（次の接続時に再起動する）
+                    cls._reaper = None
+            # 切断は時間がかかり得るので、プールのロックを放してから行う
+            for ssh in idle:
+                cls._close(ssh)
+            if stop:
+                return
+
+    @staticmethod
+    def _close(ssh):
+        try:
+            ssh.disconnect()
+        except Exception:
+            pass
+
+# マスキング規則を1本の正規表現に融合し、本文を1回の走査で置換する。
+# 以前の「規則ごとに順番に re.sub」と同じ結果になるよう、選択肢の並びと形を揃えている:
+#  - "encrypted password 5 xxx" は先に password 規則が当たった後と同じ形にする
+#  - 直後のトークンが "secret 5 xxx" / "encrypted password xxx" 型なら、順次適用時と同じく両方を伏せる
+#  - username ... secret N xxx 規則は password/secret 規則が先に伏せるため到達不能だった（省略）
+# グローバル IPv4（10/8, 172.16/12, 192.168/16 以外）を先読み無しの正の形で書いたもの。
+# 第1・第2オクテットを「除外値以外」の選択肢に展開してあり、位置ごとの否定先読みが要らない（RE2 でも使える形）
+_PUBLIC_IPV4 = (
+    r'(?:'
+    # 先頭が 10 / 172 / 192 以外
+    r'(?:\d|[02-9]\d|1[1-9]|[02-9]\d\d|1[0-68]\d|17[013-9]|19[013-9])\.\d{1,3}'
+    # 172.x で x が 16〜31 以外
+    r'|172\.(?:\d|[04-9]\d|1[0-5]|3[2-9]|\d{3})'
+    # 192.x で x が 168 以外
+    r'|192\.(?:\d{1,2}|[02-9]\d\d|1[0-57-9]\d|16[0-79])'
+    r')\.\d{1,3}\.\d{1,3}'
+)
+
+# google-re2 が入っていれば線形時間の RE2 で走らせる（無ければ標準の re）。
+# RE2 の \b / \d / \S は ASCII 基準なので、日本語に隣接した IP なども伏せる側に倒れる。
+try:
+    import re2 as _sanitize_engine
+except ImportError:
+    _sanitize_engine = re
+
+_SANITIZE_PATTERN = (
+    r'(?P<enc_chain>encrypted password \S*(?:password|secret) \d+ \S+)'
+    r'|(?P<enc>encrypted password (?:\d+ )?\S+)'
+    r'|(?P<pw>(?P<pw_kw>password|secret) \d+ \S+)'
+    r'|(?P<comm_enc_chain>snmp-server community \S*encrypted password \S*(?:password|secret) \d+ \S+)'
+    r'|(?P<comm_enc>snmp-server community \S*encrypted password (?:\d+ )?\S+)'
+    r'|(?P<comm_chain>snmp-server community \S*(?:password|secret) \d+ \S+)'
+    r'|(?P<comm>snmp-server community \S+)'
+    r'|(?P<ip>\b' + _PUBLIC_IPV4 + r'\b)'
+    r'|(?P<mac>(?:[0-9A-Fa-f]{4}\.){2}[0-9A-Fa-f]{4})'
+)
+_SANITIZE_REPLACEMENTS = {
+    "enc_chain": lambda m: "encrypted password <HIDDEN_PASSWORD> <HIDDEN_PASSWORD>",
+    "enc": lambda m: "encrypted password <HIDDEN_PASSWORD>",
+    "pw": lambda m: f"{m['pw_kw']} <HIDDEN_PASSWORD>",
+    "comm_enc_chain": lambda m: "snmp-server community <HIDDEN_COMMUNITY> password <HIDDEN_PASSWORD> <HIDDEN_PASSWORD>",
+    "comm_enc": lambda m: "snmp-server community <HIDDEN_COMMUNITY> password <HIDDEN_PASSWORD>",
+    "comm_chain": lambda m: "snmp-server community <HIDDEN_COMMUNITY> <HIDDEN_PASSWORD>",
+    "comm": lambda m: "snmp-server community <HIDDEN_COMMUNITY>",
+    "ip": lambda m: "<MASKED_PUBLIC_IP>",
+    "mac": lambda m: "<MASKED_MAC>",
+}
+
+def _sanitize_replace(m) -> str:
+    return _SANITIZE_REPLACEMENTS[m.lastgroup](m)
+
+# 全規則を一通り通す見本（RE2 の match オブジェクトで lastgroup / 名前参照が使えるかの確認用）
+_SANITIZE_PROBE = (
+    "password 7 x 8.8.8.8\n"
+    "encrypted password 5 abc secret 5 def\n"
+    "snmp-server community pub encrypted password 7 y\n"
+    "snmp-server community priv RO 0011.2233.4455 10.0.0.1"
+)
+
+def _compile_sanitize(pattern):
+    """
+    選んだエンジンでコンパイルし、見本の置換結果が標準 re と一致する時だけ採用する。
+    コンパイル失敗に限らず、置換時の例外（match オブジェクトの API 差）や結果の食い違いがあれば re に戻す。
+    """
+    fallback = re.compile(pattern)
+    if _sanitize_engine is re:
+        return fallback
+    try:
+        compiled = _sanitize_engine.compile(pattern)
+        if compiled.sub(_sanitize_replace, _SANITIZE_PROBE) == fallback.sub(_sanitize_replace, _SANITIZE_PROBE):
+            return compiled
+    except Exception:
+        pass
+    return fallback
+
+_SANITIZE_RE = _compile_sanitize(_SANITIZE_PATTERN)
+
+# どの規則も、このいずれかの部分文字列が無ければ一致し得ない（IP/MAC は "." を必ず含む）
+_SANITIZE_NEEDLES = (".", "password", "secret", "community")
+
+def _sanitize(text: str) -> str:
+    # 該当しそうな文字列が無い短い出力（プロンプト行・状態行など）は正規表現を走らせない
+    if not any(needle in text for needle in _SANITIZE_NEEDLES):
+        return text
+    return _SANITIZE_RE.sub(_sanitize_replace, text)
+
 def sanitize_output(text: str) -> str:
-    rules = [
-        (r'(password|secret) \d+ \S+', r'\1 <HIDDEN_PASSWORD>'),
-        (r'(encrypted password) \S+', r'\1 <HIDDEN_PASSWORD>'),
-        (r'(snmp-server community) \S+', r'\1 <HIDDEN_COMMUNITY>'),
-        (r'(username \S+ privilege \d+ secret \d+) \S+', r'\1 <HIDDEN_SECRET>'),
-        (r'\b(?!(?:10|172\.(?:1[6-9]|2\d|3[01])|192\.168)\.)\d{1,3}\.(?:\d{1,3}\.){2}\d{1,3}\b', '<MASKED_PUBLIC_IP>'),
-        (r'([0-9A-Fa-f]{4}\.){2}[0-9A-Fa-f]{4}', '<MASKED_MAC>'),
-    ]
-    for pattern, replacement in rules:
-        text = re.sub(pattern, replacement, text)
+    # キャッシュしない（引数の生ログ＝マスキング前の秘密情報をキャッシュのキーとして残さないため）
+    return _sanitize(text)
+
+class StreamSanitizer:
+    """
+    ストリーミングで届くテキストを逐次マスキングする。
+    どの規則も改行をまたいで一致しないので、行が閉じた所まで処理し、書きかけの行だけ持ち越す。
+    feed / flush の出力を連結すると sanitize_output(全文) と同じになる。
+    """
+    __slots__ = ("_carry",)
+
+    def __init__(self):
+        self._carry = ""
+
+    def feed(self, chunk: str) -> str:
+        text = self._carry + chunk
+        cut = text.rfind("\n") + 1
+        self._carry = text[cut:]
+        return _sanitize(text[:cut]) if cut else ""
+
+    def flush(self) -> str:
+        text, self._carry = self._carry, ""
+        return _sanitize(text)
+
+# 生成結果のメモ（キーはモデル・温度・プロンプト全文。デモで同じシナリオ/機器を繰り返す時に API を呼ばない）
+# 既定はメモリ上の LRU のみ。AIOPS_CACHE_DISK=1 の時だけプロジェクト直下の .ai_cache/ にも書き残し、
+# 再起動後のデモでも API を呼ばない（件数は _DISK_CACHE_MAX まで。超えたら古いものから消す）。
+# ユーザーの入力（現在の Config など）から作った生成結果はディスクに書かない（persist=False）。
+# 毎回違うログを見せたい時は AIOPS_CACHE_DISABLE=1 で両方とも無効にする。
+_GEN_MODEL = "gemma-3-12b-it"
+_GEN_CACHE_MAX = 128
+_gen_cache = OrderedDict()
+_gen_cache_lock = threading.Lock()
+_CACHE_DISABLED = os.environ.get("AIOPS_CACHE_DISABLE", "").strip().lower() in ("1", "true", "yes")
+_DISK_CACHE_ENABLED = os.environ.get("AIOPS_CACHE_DISK", "").strip().lower() in ("1", "true", "yes")
+_DISK_CACHE_MAX = env_int("AIOPS_CACHE_DISK_MAX", 512, minimum=1)
+_DISK_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".ai_cache", "generated")
+_disk_cache = {"shelf": None, "failed": False}
+_disk_cache_lock = threading.Lock()
+
+# クォータ/容量系エラーのサーキットブレーカー。
+# 連続 _BREAKER_THRESHOLD 回失敗したら _BREAKER_COOLDOWN_SEC の間は API を呼ばずに即失敗させ、
+# SDK 側の長いリトライ待ちを各画面操作で踏まないようにする。数えるのはクォータ/容量系（429 / 503）だけで、
+# タイムアウトは数えない（長い出力で時間が掛かっただけのことがあるため）。
+# 非ストリーミングの呼び出しは _GEN_TIMEOUT_SEC で打ち切る（ストリーミングは応答全体の期限になってしまうので付けない）。
+_BREAKER_THRESHOLD = 3
+_BREAKER_COOLDOWN_SEC = 60.0
+_GEN_TIMEOUT_SEC = 15
+_breaker = {"failures": 0, "open_until": 0.0}
+_breaker_lock = threading.Lock()
+
+class GenerationUnavailable(RuntimeError):
+    """ブレーカーが開いていて生成を見合わせている"""
+
+def _breaker_check():
+    with _breaker_lock:
+        remaining = _breaker["open_until"] - time.monotonic()
+    if remaining > 0:
+        raise GenerationUnavailable(f"AI quota/capacity errors persisted; retry in {remaining:.0f}s")
+
+def _breaker_record(error=None):
+    """呼び出し結果を記録する（error=None は成功）"""
+    with _breaker_lock:
+        if error is None:
+            _breaker["failures"] = 0
+        elif is_capacity_error(error):
+            _breaker["failures"] += 1
+            if _breaker["failures"] >= _BREAKER_THRESHOLD:
+                _breaker["open_until"] = time.monotonic() + _BREAKER_COOLDOWN_SEC
+                _breaker["failures"] = 0
+
+def _disk_key(key):
+    return hashlib.blake2b(repr(key).encode("utf-8"), digest_size=20).hexdigest()
+
+def _disk_shelf():
+    """ディスクキャッシュを開く（呼び出し側で _disk_cache_lock を保持）。開けなければ以後はメモリのみ"""
+    if not _DISK_CACHE_ENABLED:
+        return None
+    if _disk_cache["shelf"] is None and not _disk_cache["failed"]:
+        try:
+            os.makedirs(os.path.dirname(_DISK_CACHE_PATH), exist_ok=True)
+            _disk_cache["shelf"] = shelve.open(_DISK_CACHE_PATH)
+        except Exception as e:
+            print(f"AI cache disabled (disk): {e}")
+            _disk_cache["failed"] = True
+    return _disk_cache["shelf"]
+
+# API 呼び出しの共通部分。再試行とレート制限は ai_retry の共通ポリシー（app のレポート/チャットと共有）。
+# ブレーカーには再試行し尽くした最終結果だけを記録する。
+@ai_call_retry
+def _call_model(model, prompt, on_text=None):
+    ai_rate_limiter.acquire()
+    if not on_text:
+        return model.generate_content(prompt, request_options={"timeout": _GEN_TIMEOUT_SEC}).text
+    text = ""
+    for chunk in model.generate_content(prompt, stream=True):
+        text += chunk.text
+        on_text(text)
     return text
 
-def generate_fake_log_by_ai(scenario_name, target_node, api_key):
+def _gen_cache_get(key):
+    if _CACHE_DISABLED:
+        return None
+    with _gen_cache_lock:
+        text = _gen_cache.get(key)
+        if text is not None:
+            _gen_cache.move_to_end(key)
+            return text
+    with _disk_cache_lock:
+        shelf = _disk_shelf()
+        try:
+            entry = shelf.get(_disk_key(key)) if shelf is not None else None
+        except Exception:
+            entry = None
+    # 値は (書き込み時刻, 本文)。形の違う古い値は使わない
+    text = entry[1] if isinstance(entry, tuple) and len(entry) == 2 else None
+    if text is not None:
+        with _gen_cache_lock:
+            _gen_cache[key] = text
+            if len(_gen_cache) > _GEN_CACHE_MAX:
+                _gen_cache.popitem(last=False)
+    return text
+
+def _disk_evict(shelf):
+    """件数が _DISK_CACHE_MAX を超えた分を、書き込みの古いものから消す（呼び出し側で _disk_cache_lock を保持）"""
+    overflow = len(shelf) - _DISK_CACHE_MAX
+    if overflow <= 0:
+        return
+    def _stored_at(k):
+        entry = shelf.get(k)
+        return entry[0] if isinstance(entry, tuple) and len(entry) == 2 else 0.0
+    for k in sorted(shelf.keys(), key=_stored_at)[:overflow]:
+        del shelf[k]
+
+def _gen_cache_put(key, text, persist=True):
+    if _CACHE_DISABLED:
+        return
+    with _gen_cache_lock:
+        _gen_cache[key] = text
+        if len(_gen_cache) > _GEN_CACHE_MAX:
+            _gen_cache.popitem(last=False)
+    if not persist:
+        return
+    with _disk_cache_lock:
+        shelf = _disk_shelf()
+        if shelf is not None:
+            try:
+                shelf[_disk_key(key)] = (time.time(), text)
+                _disk_evict(shelf)
+                shelf.sync()
+            except Exception as e:
+                print(f"AI cache write failed: {e}")
+
+def _generate_text(prompt, api_key, temperature=0.0, on_text=None, persist=True):
     """
-    シナリオ名と機器メタデータから、AIが自律的に障害ログを生成する
-    （ルールベースの分岐を廃止）
+    generate_content のメモ化ラッパー。例外はそのまま送出し、失敗結果は記録しない。
+    on_text を渡すとストリーミングで生成し、チャンクが届くたびに途中までの全文で呼ぶ。
+    persist=False ならディスクキャッシュには書かない（プロンプトにユーザーの設定内容などを含む場合）。
     """
-    if not api_key: return "Error: API Key Missing"
-    
-    genai.configure(api_key=api_key)
-    # 推論能力が高いモデルを使用
-    model = genai.GenerativeModel(
-        "gemma-3-12b-it",
-        generation_config={"temperature": 0.2} # 多少の創造性を持たせるため0.0から少し上げる
-    )
-    
-    # ノード情報（JSONから取得）
-    vendor = target_node.metadata.get("vendor", "Generic")
-    os_type = target_node.metadata.get("os", "Generic OS")
-    model_name = target_node.metadata.get("model", "Generic Device")
-    hostname = target_node.id
-
-    # プロンプト：AIへの指示書
-    # 具体的な「電源ならこうしろ」という指示を削除し、
-    # 「シナリオ名を解釈して、それっぽいログを作れ」というメタな指示に変更
-    prompt = f"""
+    key = (_GEN_MODEL, temperature, prompt)
+    cached = _gen_cache_get(key)
+    if cached is not None:
+        if on_text: on_text(cached)
+        return cached
+
+    _breaker_check()
+    model = _ai_manager.get_model(api_key, _GEN_MODEL, {"temperature": temperature})
+    try:
+        text = _call_model(model, prompt, on_text)
+    except Exception as e:
+        _breaker_record(e)
+        raise
+    _breaker_record()
+    _gen_cache_put(key, text, persist)
+    return text
+
+def _prompt_template(text):
+    """
+    プロンプトのテンプレートを作る。ソース上の字下げと前後の空行を落としておき、
+    毎回のリクエストで無駄な空白（入力トークン）を送らない。
+    """
+    return Template(textwrap.dedent(text).strip() + "\n")
+
+# プロンプト：AIへの指示書（固定部分はモジュール読み込み時に1回だけ組み立て、呼び出し時は差し込みのみ）
+# 具体的な「電源ならこうしろ」という指示を削除し、
+# 「シナリオ名を解釈して、それっぽいログを作れ」というメタな指示に変更
+_FAKE_LOG_PROMPT = _prompt_template("""
     あなたはネットワーク機器のCLIシミュレーター（熟練エンジニアのロールプレイング）です。
     ユーザーが指定した「障害シナリオ」に基づいて、トラブルシューティング時に実行されるであろう
     **「コマンド」とその「実行結果ログ」** を生成してください。
 
     【入力情報】
-    - 対象ホスト名: {hostname}
-    - ベンダー: {vendor}
-    - OS種別: {os_type}
-    - モデル: {model_name}
-    - **発生している障害シナリオ**: 「{scenario_name}」
+    - 対象ホスト名: $hostname
+    - ベンダー: $vendor
+    - OS種別: $os_type
+    - モデル: $model_name
+    - **発生している障害シナリオ**: 「$scenario_name」
 
     【AIへの指示】
     1. **シナリオの解釈**: 提供されたシナリオ名（例: "電源障害", "BGP Flapping", "Cable Cut"など）から、技術的にどのような状態であるべきか推測してください。
-    2. **コマンド選択**: その障害を確認するために、このベンダー({vendor})でよく使われる確認コマンドを2〜3個選んでください。（例: show environment, show log, show ip bgp sum, show interface 等）
+    2. **コマンド選択**: その障害を確認するために、このベンダー($vendor)でよく使われる確認コマンドを2〜3個選んでください。（例: show environment, show log, show ip bgp sum, show interface 等）
     3. **ログ生成**: 選んだコマンドに対し、シナリオ通りの異常状態を示す出力を生成してください。
        - 電源障害なら: Power Supply Status を Faulty/Failed にする。
        - インターフェース障害なら: Protocol Down にする。
@@ -79,136 +449,282 @@ def generate_fake_log_by_ai(scenario_name, target_node, api_key):
     【出力形式】
     解説不要。CLIのテキストデータのみを出力してください。
     Markdownのコードブロックは使用しないでください（生テキストで出力）。
+    """)
+
+@lru_cache(maxsize=256)
+def _fake_log_prompt_for(scenario_name, hostname, vendor, os_type, model_name):
+    # シナリオ × 機器の組み合わせは少ないので、組み立て済みのプロンプトを使い回す
+    # （同じ str オブジェクトが返るので、生成メモのキーのハッシュも再計算されない）
+    return _FAKE_LOG_PROMPT.substitute(
+        hostname=hostname, vendor=vendor, os_type=os_type,
+        model_name=model_name, scenario_name=scenario_name,
+    )
+
+def _fake_log_prompt(scenario_name, target_node):
+    # ノード情報（JSONから取得）
+    meta = target_node.metadata
+    return _fake_log_prompt_for(
+        scenario_name,
+        target_node.id,
+        meta.get("vendor", "Generic"),
+        meta.get("os", "Generic OS"),
+        meta.get("model", "Generic Device"),
+    )
+
+# 障害ログ生成の温度（多少の創造性を持たせるため0.0から少し上げる）
+_FAKE_LOG_TEMPERATURE = 0.2
+
+def generate_fake_log_by_ai(scenario_name, target_node, api_key, on_text=None):
     """
-    
+    シナリオ名と機器メタデータから、AIが自律的に障害ログを生成する
+    （ルールベースの分岐を廃止）
+    on_text を渡すとストリーミングで生成し、途中までの全文で呼ぶ。
+    """
+    if not api_key: return "Error: API Key Missing"
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return _generate_text(
+            _fake_log_prompt(scenario_name, target_node), api_key,
+            temperature=_FAKE_LOG_TEMPERATURE, on_text=on_text,
+        )
     except Exception as e:
         return f"AI Generation Error: {e}"
 
-def generate_config_from_intent(target_node, current_config, intent_text, api_key):
-    if not api_key: return "Error: API Key Missing"
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemma-3-12b-it", generation_config={"temperature": 0.0})
-    
-    vendor = target_node.metadata.get("vendor", "Unknown Vendor")
-    os_type = target_node.metadata.get("os", "Unknown OS")
-    
-    prompt = f"""
+_CONFIG_PROMPT = _prompt_template("""
     ネットワーク設定生成。
-    対象: {target_node.id} ({vendor} {os_type})
-    現在のConfig: {current_config}
-    Intent: {intent_text}
+    対象: $target_id ($vendor $os_type)
+    現在のConfig: $current_config
+    Intent: $intent_text
     出力: 投入用コマンドのみ (Markdownコードブロック)
-    """
+    """)
+
+def generate_config_from_intent(target_node, current_config, intent_text, api_key):
+    if not api_key: return "Error: API Key Missing"
+    prompt = _CONFIG_PROMPT.substitute(
+        target_id=target_node.id,
+        vendor=target_node.metadata.get("vendor", "Unknown Vendor"),
+        os_type=target_node.metadata.get("os", "Unknown OS"),
+        current_config=current_config,
+        intent_text=intent_text,
+    )
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        # 現在の Config を含むので、生成結果はディスクに残さない
+        return _generate_text(prompt, api_key, persist=False)
     except Exception as e:
         return f"Config Gen Error: {e}"
 
+_HEALTH_CHECK_PROMPT = Template("Netmiko正常性確認コマンドを3つ生成せよ。対象: $vendor $os_type。出力: コマンドのみ箇条書き")
+
 def generate_health_check_commands(target_node, api_key):
     if not api_key: return "Error: API Key Missing"
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemma-3-12b-it", generation_config={"temperature": 0.0})
-    
-    vendor = target_node.metadata.get("vendor", "Unknown Vendor")
-    os_type = target_node.metadata.get("os", "Unknown OS")
-    
-    prompt = f"Netmiko正常性確認コマンドを3つ生成せよ。対象: {vendor} {os_type}。出力: コマンドのみ箇条書き"
+    prompt = _HEALTH_CHECK_PROMPT.substitute(
+        vendor=target_node.metadata.get("vendor", "Unknown Vendor"),
+        os_type=target_node.metadata.get("os", "Unknown OS"),
+    )
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return _generate_text(prompt, api_key)
     except Exception as e:
         return f"Command Gen Error: {e}"
 
-def generate_remediation_commands(scenario, analysis_result, target_node, api_key):
-    """
-    障害シナリオと分析結果に基づき、復旧手順（物理対応＋コマンド＋確認）を生成する
-    """
-    if not api_key: return "Error: API Key Missing"
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemma-3-12b-it", generation_config={"temperature": 0.0})
-    
-    prompt = f"""
-    あなたは熟練したネットワークエンジニアです。
-    発生している障害に対して、オペレーターが実行すべき**「完全な復旧手順書」**を作成してください。
-    
-    対象デバイス: {target_node.id} ({target_node.metadata.get('vendor')} {target_node.metadata.get('os')})
-    発生シナリオ: {scenario}
-    AI分析結果: {analysis_result}
-    
-    【重要: 出力要件】
-    以下の3つのセクションを必ず含めてください。Markdown形式で出力すること。
+# 復旧手順と復旧後の確認ログを1回の呼び出しでまとめて生成するための区切り
+# （gemma は JSON モード非対応で、手順書には Markdown のコードブロックも入るため JSON にはしない）
+_PLAN_MARK = "===REMEDIATION_PLAN==="
+_VERIFY_MARK = "===VERIFICATION_LOG==="
+# 区切り行は固定なので、テンプレート作成時に埋め込んでおく
+_BUNDLE_PROMPT = Template(_prompt_template("""
+    あなたは熟練したネットワークエンジニアです。以下の2つを続けて出力してください。
 
-    ### 1. 物理・前提アクション (Physical Actions)
-    * 電源障害やケーブル断、FAN故障の場合、「交換手順」や「結線確認」を具体的に指示してください。
-    * 例：「故障した電源ユニット(PSU1)を交換してください」「LANケーブルを再結線してください」など。
-    * ソフトウェア設定のみで直る場合は「特になし」で構いません。
+    対象デバイス: $target_id ($vendor $os_type / $model_name)
+    発生シナリオ: $scenario
+    AI分析結果: $analysis_result
 
+    【出力形式】必ず次の区切り行で2つのパートに分けること（区切り行はそのまま1行で出力）。
+    $plan_mark
+    オペレーターが実行すべき「完全な復旧手順書」（Markdown）。以下の3セクションを必ず含める。
+    ### 1. 物理・前提アクション (Physical Actions)
+    * 電源障害やケーブル断、FAN故障の場合は交換手順や結線確認を具体的に指示。ソフトウェア設定のみで直る場合は「特になし」。
     ### 2. 復旧コマンド (Recovery Config)
-    * 設定変更や再起動が必要な場合のコマンド。
-    * 物理交換だけで復旧する場合でも、念のためのインターフェースリセット手順などを記載してください。
-    * コマンドは Markdownのコードブロック(```) で囲んでください。
-
+    * 設定変更や再起動が必要な場合のコマンド。物理交換だけで復旧する場合もインターフェースリセット手順などを記載。
+    * コマンドは Markdownのコードブロック(```) で囲む。
     ### 3. 正常性確認コマンド (Verification Commands)
-    * 対応後に正常に戻ったかを確認するためのコマンド（showコマンドやpingなど）。
-    * 必ず3つ以上提示してください。
-    * コマンドは Markdownのコードブロック(```) で囲んでください。
+    * 対応後に正常に戻ったかを確認するコマンド（showコマンドやpingなど）を3つ以上。
+    * コマンドは Markdownのコードブロック(```) で囲む。
+    $verify_mark
+    復旧後に上記の正常性確認コマンドを実行した結果のCLIログ（全て OK/Up の正常状態）。
+    タイムスタンプやプロンプトを含め本物のCLI画面のように。解説不要、Markdownのコードブロックは使わない。
+    """).safe_substitute(plan_mark=_PLAN_MARK, verify_mark=_VERIFY_MARK))
+
+def generate_remediation_bundle(scenario, analysis_result, target_node, api_key, on_plan=None):
     """
-    
+    復旧手順書と「復旧後の正常性確認ログ」を1回の API 呼び出しで生成する。
+    戻り値: {"plan": 手順書(Markdown), "verification_log": 確認ログ or None}
+    区切りが崩れていた場合は全文を手順書として返し、確認ログは None（呼び出し側で個別生成）。
+    on_plan を渡すとストリーミングで生成し、手順書パートを届いたところまで渡す（逐次表示用）。
+    """
+    if not api_key: return {"plan": "Error: API Key Missing", "verification_log": None}
+
+    meta = target_node.metadata
+    prompt = _BUNDLE_PROMPT.substitute(
+        target_id=target_node.id,
+        vendor=meta.get("vendor", "Generic"),
+        os_type=meta.get("os", "Generic OS"),
+        model_name=meta.get("model", "Generic Device"),
+        scenario=scenario,
+        analysis_result=analysis_result,
+    )
+
+    def _on_text(buf):
+        head = buf.partition(_VERIFY_MARK)[0]
+        # 書きかけの区切り行（"===..."）は表示しない
+        last_nl = head.rfind("\n")
+        if head[last_nl + 1:].startswith("="):
+            head = head[:last_nl + 1]
+        on_plan(head.replace(_PLAN_MARK, "").strip())
+
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        text = _generate_text(prompt, api_key, on_text=_on_text if on_plan else None)
     except Exception as e:
-        return f"Remediation Gen Error: {e}"
+        return {"plan": f"Remediation Gen Error: {e}", "verification_log": None}
 
-def run_diagnostic_simulation(scenario_type, target_node=None, api_key=None):
-    time.sleep(1.5)
-    
+    head, sep, verification = text.partition(_VERIFY_MARK)
+    plan = head.replace(_PLAN_MARK, "").strip()
+    verification = verification.strip()
+    if not sep or not plan or not verification:
+        return {"plan": text.replace(_PLAN_MARK, "").replace(_VERIFY_MARK, "").strip(), "verification_log": None}
+    return {"plan": plan, "verification_log": verification}
+
+def _split_batched_output(output, prompt, commands):
+    """
+    一括送信した出力を、コマンドのエコー行を目印にコマンドごとへ分割する。
+    エコーが見つからない等で分割できなければ None。
+    """
+    marks = []
+    pos = 0
+    for cmd in commands:
+        i = output.find(cmd, pos)
+        if i < 0:
+            return None
+        eol = output.find("\n", i)
+        pos = len(output) if eol < 0 else eol + 1
+        marks.append((i, pos))
+    sections = []
+    for k, (_, body_start) in enumerate(marks):
+        end = marks[k + 1][0] if k + 1 < len(marks) else len(output)
+        text = output[body_start:end].rstrip()
+        # 次コマンドのエコー行の先頭（プロンプト）を落とす
+        if prompt and text.endswith(prompt):
+            text = text[:-len(prompt)].rstrip()
+        sections.append(text)
+    return sections
+
+# 一括送信の出力が末尾のプロンプトまで揃うのを待つ上限（秒）
+_LIVE_READ_TIMEOUT_SEC = 20.0
+
+def _send_commands(ssh, prompt, commands):
+    """
+    show 系コマンドをまとめて1回で送り、プロンプト待ちの往復をコマンド数ぶん払わないようにする。
+    send_command_timing は出力が途切れた時点で戻るので、末尾にプロンプトが戻るまで読み足す。
+    最後のコマンドの出力が揃った確証（末尾のプロンプト）が無い・分割できない場合は、従来どおり1コマンドずつ送る。
+    """
+    output = ssh.send_command_timing(
+        "\n".join(commands), strip_prompt=False, strip_command=False, cmd_verify=False
+    )
+    if prompt and not output.rstrip().endswith(prompt):
+        try:
+            output += ssh.read_until_pattern(pattern=re.escape(prompt), read_timeout=_LIVE_READ_TIMEOUT_SEC)
+        except Exception:
+            pass
+    complete = bool(prompt) and output.rstrip().endswith(prompt)
+    sections = _split_batched_output(output, prompt, commands) if complete else None
+    if sections is None:
+        sections = [ssh.send_command(cmd) for cmd in commands]
+    return list(zip(commands, sections))
+
+def run_diagnostic_simulation(scenario_type, target_node=None, api_key=None, on_log=None):
+    """
+    演出の待ち（demo_pace）を入れるのは実際に診断した SUCCESS の時だけ（SKIPPED / ERROR は即返す）。
+    on_log: AI 生成のログをストリーミングで受け取り、マスキング済みの途中経過で呼ぶ（逐次表示用）。
+    """
+    # 演出の待ちは診断そのもの（SSH / AI 生成）と重ねる
+    started = time.monotonic()
+    result = _run_diagnostic(scenario_type, target_node, api_key, on_log)
+    if result["status"] == "SUCCESS":
+        demo_pace(started)
+    return result
+
+def _diagnostic_kind(scenario_type):
+    """シナリオ名から診断の種類を判定する: skip / live / down / ai"""
     if "---" in scenario_type or "正常" in scenario_type:
+        return "skip"
+    if "[Live]" in scenario_type:
+        return "live"
+    if "全回線断" in scenario_type or "サイレント" in scenario_type or "両系" in scenario_type:
+        return "down"
+    return "ai"
+
+def _stream_fake_log(scenario_type, target_node, api_key, on_log):
+    """生成とマスキングを重ね、マスキング済みの途中経過を on_log に渡しながら障害ログを作る"""
+    state = {"sanitizer": StreamSanitizer(), "parts": [], "seen": ""}
+
+    def _on_text(text):
+        if not text.startswith(state["seen"]):
+            # 再試行などで最初から届き直した
+            state.update(sanitizer=StreamSanitizer(), parts=[], seen="")
+        out = state["sanitizer"].feed(text[len(state["seen"]):])
+        state["seen"] = text
+        if out:
+            state["parts"].append(out)
+            on_log("".join(state["parts"]))
+
+    raw_output = generate_fake_log_by_ai(scenario_type, target_node, api_key, on_text=_on_text)
+    if raw_output != state["seen"]:
+        # エラー文言などストリームを経由しなかった結果
+        return sanitize_output(raw_output)
+    state["parts"].append(state["sanitizer"].flush())
+    sanitized = "".join(state["parts"])
+    on_log(sanitized)
+    return sanitized
+
+# Live 診断で実行する show コマンド（_send_commands で1回にまとめて送る）。
+# ページング無効化（terminal length 0）は Netmiko が接続時の session_preparation で済ませているので送らない
+_LIVE_COMMANDS = ("show version", "show interface brief", "show ip route")
+# Live 診断ログのコマンド区切り
+_LIVE_SECTION_SEP = "\n" + "=" * 30 + "\n"
+
+def _run_diagnostic(scenario_type, target_node, api_key, on_log=None):
+    kind = _diagnostic_kind(scenario_type)
+    if kind == "skip":
         return {"status": "SKIPPED", "sanitized_log": "No action required.", "error": None}
 
-    if "[Live]" in scenario_type:
-        commands = ["terminal length 0", "show version", "show interface brief", "show ip route"]
+    if kind == "live":
         try:
-            with ConnectHandler(**SANDBOX_DEVICE) as ssh:
+            with SSHPool.session(SANDBOX_DEVICE) as ssh:
                 if not ssh.check_enable_mode(): ssh.enable()
                 prompt = ssh.find_prompt()
-                raw_output = f"Connected to: {prompt}\n"
-                for cmd in commands:
-                    output = ssh.send_command(cmd)
-                    raw_output += f"\n{'='*30}\n[Command] {cmd}\n{output}\n"
+                parts = [f"Connected to: {prompt}\n"]
+                for cmd, output in _send_commands(ssh, prompt, _LIVE_COMMANDS):
+                    parts.append(f"{_LIVE_SECTION_SEP}[Command] {cmd}\n{output}\n")
+                raw_output = "".join(parts)
         except Exception as e:
             return {"status": "ERROR", "sanitized_log": "", "error": str(e)}
         return {"status": "SUCCESS", "sanitized_log": sanitize_output(raw_output), "error": None}
             
-    elif "全回線断" in scenario_type or "サイレント" in scenario_type or "両系" in scenario_type:
+    elif kind == "down":
         return {"status": "ERROR", "sanitized_log": "", "error": "Connection timed out"}
 
     else:
+        if api_key and target_node and on_log:
+            return {"status": "SUCCESS", "sanitized_log": _stream_fake_log(scenario_type, target_node, api_key, on_log), "error": None}
         if api_key and target_node:
             raw_output = generate_fake_log_by_ai(scenario_type, target_node, api_key)
             return {"status": "SUCCESS", "sanitized_log": sanitize_output(raw_output), "error": None}
         else:
             return {"status": "ERROR", "sanitized_log": "", "error": "API Key or Target Node Missing"}
 
-def predict_initial_symptoms(scenario_name, api_key):
-    """
-    障害シナリオ名から、発生しうる「初期症状（アラーム、ログ、Pingなど）」を
-    AIに推論させ、ベイズエンジンへの入力データとして返す。
-    """
-    if not api_key: return {}
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel("gemma-3-12b-it", generation_config={"temperature": 0.0})
-    
-    prompt = f"""
+_SYMPTOM_PROMPT = _prompt_template("""
     あなたはネットワーク監視システムのAIエージェントです。
     指定された「障害シナリオ」において、監視システムが最初に検知するであろう「初期症状」を推論してください。
 
-    **シナリオ**: {scenario_name}
+    **シナリオ**: $scenario_name
 
     【出力要件】
     1. 以下のキーを持つ **JSON形式** で出力すること。解説は不要。
@@ -223,15 +739,21 @@ def predict_initial_symptoms(scenario_name, api_key):
 
     **例**:
     シナリオ: "[WAN] BGPルートフラッピング"
-    出力: {{ "alarm": "BGP Flapping", "ping": "OK", "log": "" }}
+    出力: { "alarm": "BGP Flapping", "ping": "OK", "log": "" }
+    """)
+
+def predict_initial_symptoms(scenario_name, api_key):
+    """
+    障害シナリオ名から、発生しうる「初期症状（アラーム、ログ、Pingなど）」を
+    AIに推論させ、ベイズエンジンへの入力データとして返す。
     """
+    if not api_key: return {}
+    
+    prompt = _SYMPTOM_PROMPT.substitute(scenario_name=scenario_name)
     
     try:
-        response = model.generate_content(prompt)
-        text = response.text
-        # Markdownのコードブロック記号を削除してJSONパース
-        text = text.replace("```json", "").replace("```", "").strip()
-        return json.loads(text)
+        # コードブロックや前置きが付いても JSON 部分だけを読む
+        return parse_json_response(_generate_text(prompt, api_key))
     except Exception as e:
         print(f"Symptom Prediction Error: {e}")
         return {}
@@ -14,9 +14,10 @@ This module centralizes:
 
 from __future__ import annotations
 
+import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from data import load_topology_from_json, NetworkNode
 
@@ -37,20 +38,36 @@ def _tenants_root() -> Path:
     return _project_root() / "tenants"
 
 
+# ディレクトリ一覧のプロセス内キャッシュ（Streamlit の再実行ごとにディレクトリを走査しないため）。
+# キーはパス、値は (mtime_ns, 一覧)。stat 1回で変更を検知し、変わっていれば読み直す。
+# パース済みトポロジーはここでは持たない（app 側の cache_resource が (path, mtime) 単位で共有する）。
+_LISTING_CACHE: Dict[Path, Tuple[int, List[str]]] = {}
+
+
+def _mtime_ns(path: Path) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _list_dirs_cached(root: Path) -> List[str]:
+    # エントリの追加/削除でディレクトリ自身の mtime が変わる
+    mt = _mtime_ns(root)
+    hit = _LISTING_CACHE.get(root)
+    if hit and hit[0] == mt:
+        return list(hit[1])
+    names = _scan_dirs(root) if mt else []
+    _LISTING_CACHE[root] = (mt, names)
+    return list(names)
+
+
 def list_tenants() -> List[str]:
-    troot = _tenants_root()
-    if not troot.exists():
-        return ["A", "B"]
-    tenants = sorted([p.name for p in troot.iterdir() if p.is_dir() and not p.name.startswith(".")])
-    return tenants or ["A", "B"]
+    return _list_dirs_cached(_tenants_root()) or ["A", "B"]
 
 
 def list_networks(tenant_id: str) -> List[str]:
-    nroot = _tenants_root() / tenant_id / "networks"
-    if not nroot.exists():
-        return ["default"]
-    nets = sorted([p.name for p in nroot.iterdir() if p.is_dir() and not p.name.startswith(".")])
-    return nets or ["default"]
+    return _list_dirs_cached(_tenants_root() / tenant_id / "networks") or ["default"]
 
 
 def get_paths(tenant_id: str, network_id: str) -> TenantNetworkPaths:
@@ -66,5 +83,34 @@ def topology_mtime(path: Path) -> float:
         return 0.0
 
 
+def _scan_dirs(root: Path) -> List[str]:
+    try:
+        with os.scandir(root) as it:
+            return sorted(e.name for e in it if e.is_dir() and not e.name.startswith("."))
+    except FileNotFoundError:
+        return []
+
+
+def enumerate_scopes() -> List[Tuple[str, str, str, float]]:
+    """
+    全スコープを (tenant, network, topology_path, mtime) で1パス列挙する。
+    list_tenants/list_networks/get_paths/topology_mtime を個別に呼ぶより stat 回数が少ない。
+    ディレクトリ一覧は list_tenants/list_networks と同じキャッシュを使い、変化が無ければ
+    ディレクトリごとの stat 1回で済ませる。フォールバック（A/B, default）も同じ。
+    """
+    troot = _tenants_root()
+    scopes: List[Tuple[str, str, str, float]] = []
+    for t in _list_dirs_cached(troot) or ["A", "B"]:
+        nroot = troot / t / "networks"
+        for n in _list_dirs_cached(nroot) or ["default"]:
+            topo = os.path.join(nroot, n, "topology.json")
+            try:
+                mtime = os.stat(topo).st_mtime
+            except FileNotFoundError:
+                mtime = 0.0
+            scopes.append((t, n, topo, mtime))
+    return scopes
+
+
 def load_topology(topology_path: Path) -> Dict[str, NetworkNode]:
     return load_topology_from_json(str(topology_path))